@@ -1,45 +1,226 @@
 # Snippet from deleted code
+import copy
+import fcntl
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, TimeoutError as FetchTimeoutError, wait
 
 
-@app.task(serializer='json')
-def create_xml(loan_id, journey_api_user, journey_api_password, template_objects):
+# Journey fetches that only depend on the loan run concurrently on this pool
+XML_FETCH_WORKERS = getattr(settings, 'XML_FETCH_WORKERS', 16)
+# Seconds create_xml waits for the concurrent fetches together
+XML_FETCH_TIMEOUT = getattr(settings, 'XML_FETCH_TIMEOUT', 30)
+# Maximum concurrent Journey calls per API user (tenant)
+XML_FETCH_TENANT_CONCURRENCY = getattr(settings, 'XML_FETCH_TENANT_CONCURRENCY', 4)
+
+fetch_executor = ThreadPoolExecutor(max_workers=XML_FETCH_WORKERS, thread_name_prefix='journey-fetch')
+_tenant_semaphores = {}
+_tenant_semaphores_lock = threading.Lock()
+
+# Worker level cache of Journey objects shared by many loans (branch with company)
+XML_FETCH_CACHE_SIZE = getattr(settings, 'XML_FETCH_CACHE_SIZE', 1024)
+# Seconds a cached object is used without asking Journey
+XML_FETCH_CACHE_TTL = getattr(settings, 'XML_FETCH_CACHE_TTL', 60)
+journey_fetch_cache = utils.LRUCache(maxsize=XML_FETCH_CACHE_SIZE, ttl=XML_FETCH_CACHE_TTL)
+
+XML_TEMPLATE_NAME = 'proloan_import.xml'
+_xml_templates = {}
+
+# Per branch index of {loan_id: fingerprint of the last rendered XML}, kept in
+# XML_STORAGE_LOCATION/.fingerprints/<company>/<branch>.json outside the served branch folders
+XML_FINGERPRINT_DIR = '.fingerprints'
+# Bump when the context building changes so all XMLs are rendered again
+XML_CONTEXT_VERSION = 1
+_fingerprint_lock = threading.Lock()
+
+_code_translators = {}
+
+# fsync XML files (and their directory) before they become visible to the Proloan monitor
+XML_FSYNC = getattr(settings, 'XML_FSYNC', False)
+XML_FILE_MODE = 0o774
+# Temp files are written next to the branch folders, not in them, so partial files never get listed
+# for download. It is under XML_STORAGE_LOCATION so os.replace stays on the same filesystem
+XML_TEMP_DIR = '.tmp'
+_known_dirs = set()
+
+LOAN_EMBEDS = ['client',
+               'branch',
+               'area',
+               'compuscan',
+               'loan_originator',
+               'payout_method',
+               'repayment_method',
+               'repayment_bank_account',
+               'product',
+               'purpose',
+               'agent']
+CLIENT_EMBEDS = ['address_physical',
+                 'employment',
+                 'client_affordability',
+                 'note']
+
+
+def fetch_xml_loan(loan_id, journey_api_user, journey_api_password):
+    loan = JourneyLoan(journey_api_user, journey_api_password)
+    loan.fetch(loan_id, to_embed=LOAN_EMBEDS)
+    return loan
+
+
+def fetch_xml_client(client_id, journey_api_user, journey_api_password):
     """
-        Can be deleted of the create_xml on cloudcode works eventually
+    Fetches the client with its references
     """
-    loan = JourneyLoan(journey_api_user, journey_api_password)
     client = JourneyClient(journey_api_user, journey_api_password)
-    branch = JourneyBranch(journey_api_user, journey_api_password)
+    client.fetch(client_id, to_embed=CLIENT_EMBEDS)
+    # Fetch References
+    references = client.fetch_related('reference')
+
+    if getattr(client, 'address_postal', None) is None:
+        client.address_postal = {}
+    if getattr(client, 'address_physical', None) is None:
+        client.address_physical = {}
+    return client, references
+
 
+def fetch_xml_branch(branch_id, journey_api_user, journey_api_password):
+    return cached_fetch(JourneyBranch, branch_id, journey_api_user, journey_api_password, to_embed=['company'])
+
+
+def cached_fetch(journey_class, object_id, journey_api_user, journey_api_password, to_embed=()):
+    """
+    Fetches a Journey object through journey_fetch_cache, objects are fetched again after XML_FETCH_CACHE_TTL
+    Returns:
+        a copy of the cached object, so callers can't change the cached one
+    """
+    key = (journey_api_user, journey_class.__name__, object_id, tuple(sorted(to_embed)))
+    journey_object = journey_fetch_cache.get(key)
+    if journey_object is not None:
+        return copy.deepcopy(journey_object)
+
+    journey_object = journey_class(journey_api_user, journey_api_password)
+    if to_embed:
+        journey_object.fetch(object_id=object_id, to_embed=list(to_embed))
+    else:
+        journey_object.fetch(object_id=object_id)
+    journey_fetch_cache.set(key, journey_object)
+    return copy.deepcopy(journey_object)
+
+
+def tenant_semaphore(journey_api_user):
+    with _tenant_semaphores_lock:
+        semaphore = _tenant_semaphores.get(journey_api_user)
+        if semaphore is None:
+            semaphore = threading.BoundedSemaphore(XML_FETCH_TENANT_CONCURRENCY)
+            _tenant_semaphores[journey_api_user] = semaphore
+    return semaphore
+
+
+def tenant_call(journey_api_user, func, *args, deadline=None):
+    """
+    Runs func while holding one of the api user's concurrency slots
+    With a deadline (time.time() value) the call is dropped when no slot frees up before it,
+    so calls the caller stopped waiting for don't take up slots
+    """
+    semaphore = tenant_semaphore(journey_api_user)
+    timeout = None if deadline is None else max(deadline - time.time(), 0)
+    if not semaphore.acquire(timeout=timeout):
+        raise Exception('No free Journey connection for %s before the deadline' % journey_api_user)
+    try:
+        return func(*args)
+    finally:
+        semaphore.release()
+
+
+def fetch_xml_objects(loan_id, journey_api_user, journey_api_password):
+    """
+    Fetches the loan, then the client (with references) and the branch concurrently
+    Only the client and branch depend on the loan, so they don't wait on each other
+    Both are waited for until one shared deadline, XML_FETCH_TIMEOUT after the loan arrived. Calls that
+    haven't started by then are dropped, a Journey call that is already running can't be interrupted and
+    keeps its pool thread and tenant slot until the Journey client returns
+    Returns:
+        (loan, client, branch, references)
+    """
+    loan = tenant_call(journey_api_user, fetch_xml_loan, loan_id, journey_api_user, journey_api_password)
+    deadline = time.time() + XML_FETCH_TIMEOUT
+    client_future = fetch_executor.submit(tenant_call, journey_api_user, fetch_xml_client,
+                                          loan.client_id, journey_api_user, journey_api_password, deadline=deadline)
+    branch_future = fetch_executor.submit(tenant_call, journey_api_user, fetch_xml_branch,
+                                          loan.branch_id, journey_api_user, journey_api_password, deadline=deadline)
+    try:
+        client, references = client_future.result(timeout=max(deadline - time.time(), 0))
+        branch = branch_future.result(timeout=max(deadline - time.time(), 0))
+    except FetchTimeoutError:
+        client_future.cancel()
+        branch_future.cancel()
+        raise Exception('Journey fetch timed out after %s seconds' % XML_FETCH_TIMEOUT)
+    except Exception:
+        client_future.cancel()
+        branch_future.cancel()
+        raise
+    return loan, client, branch, references
+
+
+def tenant_fetch_many(journey_api_user, calls):
+    """
+    Runs many Journey calls for one api user on fetch_executor
+    At most XML_FETCH_TENANT_CONCURRENCY calls are submitted at a time, so the caller never has more pool threads
+    waiting on the api user's slots than it can use. Each call is waited for until XML_FETCH_TIMEOUT after it
+    was submitted, like fetch_xml_objects a call that is already running keeps its thread until it returns
+    Args:
+        calls: list of (key, func, args)
+    Returns:
+        {key: result, or the exception the call raised or timed out with}
+    """
+    results = {}
+    calls = deque(calls)
+    running = {}  # future: (key, deadline)
+    while calls or running:
+        while calls and len(running) < XML_FETCH_TENANT_CONCURRENCY:
+            key, func, args = calls.popleft()
+            deadline = time.time() + XML_FETCH_TIMEOUT
+            future = fetch_executor.submit(tenant_call, journey_api_user, func, *args, deadline=deadline)
+            running[future] = (key, deadline)
+        timeout = max(min(deadline for key, deadline in running.values()) - time.time(), 0)
+        done = wait(running, timeout=timeout, return_when=FIRST_COMPLETED)[0]
+        now = time.time()
+        for future, (key, deadline) in list(running.items()):
+            if future in done:
+                try:
+                    results[key] = future.result()
+                except Exception as e:
+                    results[key] = e
+            elif deadline <= now:
+                future.cancel()
+                results[key] = Exception('Journey fetch timed out after %s seconds' % XML_FETCH_TIMEOUT)
+            else:
+                continue
+            del running[future]
+    return results
+
+
+@app.task(serializer='json')
+def create_xml(loan_id, journey_api_user, journey_api_password, template_objects, force=False):
+    """
+        Can be deleted of the create_xml on cloudcode works eventually
+        force: re-render the XML even if nothing changed since the last render
+    """
     if template_objects is None:  # Dynamically fetch data
         try:
-            loan.fetch(loan_id, to_embed=['client',
-                                          'branch',
-                                          'area',
-                                          'compuscan',
-                                          'loan_originator',
-                                          'payout_method',
-                                          'repayment_method',
-                                          'repayment_bank_account',
-                                          'product',
-                                          'purpose',
-                                          'agent'])
-            client.fetch(loan.client_id, to_embed=['address_physical',
-                                                   'employment',
-                                                   'client_affordability',
-                                                   'note'])
-            branch.fetch(object_id=loan.branch_id, to_embed=['company'])
-            # Fetch References
-            references = client.fetch_related('reference')
-
-            if getattr(client, 'address_postal', None) is None:
-                client.address_postal = {}
-            if getattr(client, 'address_physical', None) is None:
-                client.address_physical = {}
+            loan, client, branch, references = fetch_xml_objects(loan_id, journey_api_user, journey_api_password)
 
         except Exception as e:
             logger.error('Error fetching data dynamically: ' + str(e))
             raise Exception('Error fetching data dynamically: ' + str(e))
     else:  # Load data from blob
+        loan = JourneyLoan(journey_api_user, journey_api_password)
+        client = JourneyClient(journey_api_user, journey_api_password)
+        branch = JourneyBranch(journey_api_user, journey_api_password)
         try:
             loan.load(template_objects['loan'])
             client.load(template_objects['client'])
@@ -60,7 +241,306 @@ def create_xml(loan_id, journey_api_user, journey_api_password, template_objects
             logger.error('Error loading references: ' + str(e))
             raise Exception('Error loading references: ' + str(e))
 
+    write_loan_xml(loan, client, branch, references, force=force)
+
+
+@app.task(serializer='json')
+def create_xml_batch(loan_ids, journey_api_user, journey_api_password, force=False):
+    """
+    Creates the XML files for many loans in one task
+    Loans, then branches and clients are fetched concurrently with tenant_fetch_many (within the api user's
+    concurrency limit) and the loans are grouped per branch so each branch (with its company) is only fetched once
+    Returns:
+        {loan_id: {"path": path of the XML file} or {"error": error message}}
+    """
+    credentials = (journey_api_user, journey_api_password)
+    results = {}
+    loans_by_branch = {}
+    loans = tenant_fetch_many(journey_api_user, [(loan_id, fetch_xml_loan, (loan_id,) + credentials)
+                                                 for loan_id in loan_ids])
+    for loan_id in loan_ids:
+        loan = loans[loan_id]
+        if isinstance(loan, Exception):
+            logger.error('Error fetching loan %s: %s' % (loan_id, str(loan)))
+            results[loan_id] = {'error': 'Error fetching data dynamically: ' + str(loan)}
+        else:
+            loans_by_branch.setdefault(loan.branch_id, []).append((loan_id, loan))
+
+    calls = [(('branch', branch_id), fetch_xml_branch, (branch_id,) + credentials) for branch_id in loans_by_branch]
+    calls += [(('client', loan_id), fetch_xml_client, (loan.client_id,) + credentials)
+              for loans in loans_by_branch.values() for loan_id, loan in loans]
+    fetched = tenant_fetch_many(journey_api_user, calls)
+    for branch_id, loans in loans_by_branch.items():
+        try:
+            branch = fetched[('branch', branch_id)]
+            if isinstance(branch, Exception):
+                raise branch
+            fingerprint_index = XmlFingerprintIndex(branch)
+        except Exception as e:
+            logger.error('Error fetching branch %s: %s' % (branch_id, str(e)))
+            for loan_id, loan in loans:
+                results[loan_id] = {'error': 'Error fetching data dynamically: ' + str(e)}
+            continue
+        for loan_id, loan in loans:
+            try:
+                client = fetched[('client', loan_id)]
+                if isinstance(client, Exception):
+                    raise client
+                client, references = client
+                path = write_loan_xml(loan, client, branch, references, force=force, sync_dir=False,
+                                      fingerprint_index=fingerprint_index)
+                results[loan_id] = {'path': path}
+            except Exception as e:
+                logger.error('Error creating XML for loan %s: %s' % (loan_id, str(e)))
+                results[loan_id] = {'error': str(e)}
+        try:
+            fingerprint_index.save()
+        except Exception as e:
+            logger.error('Error saving XML fingerprints for branch %s: %s' % (branch_id, str(e)))
+        if XML_FSYNC:
+            try:
+                fsync_dir(xml_branch_dir(branch))
+            except OSError as e:
+                logger.error('Error syncing XML folder for branch %s: %s' % (branch_id, str(e)))
+    return results
+
+
+def get_xml_template():
+    """
+    Compiled proloan import template, loaded once per worker process
+    """
+    return _load_xml_template()[0]
+
+
+def get_xml_template_mtime():
+    """
+    mtime of the template file when the cached template was loaded, edits show up after a worker restart
+    """
+    return _load_xml_template()[1]
+
+
+def _load_xml_template():
+    cached = _xml_templates.get(XML_TEMPLATE_NAME)
+    if cached is None:
+        template = loader.get_template(XML_TEMPLATE_NAME)
+        template_path = getattr(getattr(template, 'origin', None), 'name', None)
+        # The mtime can be a little newer than what was loaded, that only causes an extra render
+        cached = (template, os.path.getmtime(template_path) if template_path else None)
+        _xml_templates[XML_TEMPLATE_NAME] = cached
+    return cached
+
+
+def _strip_layout_whitespace(document):
+    """
+    Removes the whitespace-only text between child nodes so a single toprettyxml
+    pass lays the document out like the legacy double pass did
+    Returns False when the document has content the single pass can't reproduce
+    exactly (mixed text, CDATA, or values the legacy re-parse would normalise)
+    """
+    stack = [document.documentElement]
+    while stack:
+        element = stack.pop()
+        for name, value in element.attributes.items():
+            if '\n' in value or '\r' in value or '\t' in value:
+                return False
+        children = element.childNodes
+        for child in list(children):
+            if child.nodeType == child.ELEMENT_NODE:
+                stack.append(child)
+            elif child.nodeType in (child.TEXT_NODE, child.COMMENT_NODE):
+                if '\r' in child.data:
+                    return False
+                if child.nodeType == child.TEXT_NODE and len(children) > 1:
+                    if child.data.strip():
+                        return False
+                    element.removeChild(child)
+            else:
+                return False
+    return True
+
+
+def render_pretty_xml(xml_string):
+    """
+    Indents the rendered template and drops blank lines
+    """
+    document = parseString(xml_string)
+    if not _strip_layout_whitespace(document):
+        # Legacy double pass for documents the fast path doesn't cover
+        document = parseString(pretty_xml.parseString(xml_string).toprettyxml())
+    return '\n'.join([line for line in document.toprettyxml(indent=' ' * 2).split('\n') if line.strip()])
+
+
+class CodeTranslator(object):
+    """
+    Code lookup tables for every enum the proloan template needs
+    Built once per datamodel version and shared by all tasks in the worker
+    """
+
+    def __init__(self, data_model):
+        self.version = data_model.version
+        self.province = data_model.option_displays['address']['province']
+        self.marital_status = data_model.options['client']['marital_status']
+        self.relation = data_model.options['reference']['relation']
+        self.instalment_frequency = data_model.options['product']['instalment_frequency']
+        self.payment_method = payment_method_types
+        self.bank_account = bank_account_types
+
+    def has_code(self, table, code):
+        try:
+            getattr(self, table)[code]
+        except (KeyError, IndexError, TypeError):
+            return False
+        return True
+
+    def validate(self, checks):
+        """
+        Checks all codes in one pass and raises a single exception listing every invalid one
+        Args:
+            checks: [(table, label, code, required)], codes that are None and not required are skipped
+        """
+        errors = []
+        for table, label, code, required in checks:
+            if code is None and not required:
+                continue
+            if not self.has_code(table, code):
+                errors.append('%s=%s' % (label, code))
+        if errors:
+            raise Exception('Invalid codes: ' + ', '.join(errors))
+
+
+def get_code_translator(data_model):
+    translator = _code_translators.get('journey')
+    if translator is None or translator.version != data_model.version:
+        translator = CodeTranslator(data_model)
+        _code_translators['journey'] = translator
+    return translator
+
+
+def xml_fingerprint(loan, client, branch, references, data_model):
+    """
+    Hash of everything that goes into the rendered XML
+    """
+    payload = {
+        'context_version': XML_CONTEXT_VERSION,
+        'loan': utils.obj_to_dict(loan),
+        'client': utils.obj_to_dict(client),
+        'branch': utils.obj_to_dict(branch),
+        'references': [utils.obj_to_dict(reference) for reference in references],
+        'datamodel': data_model.version,
+        'template': get_xml_template_mtime(),
+    }
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+def read_xml_fingerprints(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+class XmlFingerprintIndex(object):
+    """
+    Fingerprints of the XMLs rendered for one branch
+    Read once, new fingerprints are kept in memory until save() merges them into the file
+    under a file lock, so workers in other processes don't overwrite each other's entries
+    """
+
+    def __init__(self, branch):
+        self.path = '%s/%s/%s/%s.json' % (settings.XML_STORAGE_LOCATION, XML_FINGERPRINT_DIR, branch.company.id,
+                                          branch.id)
+        self.fingerprints = read_xml_fingerprints(self.path)
+        self.changed = {}
+
+    def get(self, loan_id):
+        loan_id = str(loan_id)
+        return self.changed.get(loan_id, self.fingerprints.get(loan_id))
+
+    def set(self, loan_id, fingerprint):
+        self.changed[str(loan_id)] = fingerprint
+
+    def save(self):
+        if not self.changed:
+            return
+        ensure_xml_dir(os.path.dirname(self.path))
+        with _fingerprint_lock, open(self.path + '.lock', 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                fingerprints = read_xml_fingerprints(self.path)
+                fingerprints.update(self.changed)
+                write_file_atomic(self.path, json.dumps(fingerprints).encode('utf-8'), fsync=False)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+        self.fingerprints = fingerprints
+        self.changed = {}
+
+
+def xml_branch_dir(branch):
+    return '%s/%s/%s/' % (settings.XML_STORAGE_LOCATION, branch.company.id, branch.id)
+
 
+def ensure_xml_dir(dir):
+    """
+    ensure_dir_exists, skipped for directories already known to exist in this process
+    """
+    if dir not in _known_dirs:
+        ensure_dir_exists(dir)
+        _known_dirs.add(dir)
+
+
+def fsync_dir(dir):
+    fd = os.open(dir, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def write_file_atomic(path, data, fsync=XML_FSYNC, sync_dir=True):
+    """
+    Writes data to a temp file in XML_TEMP_DIR with the final permissions and moves it into place,
+    so readers never see a partially written file
+    Args:
+        fsync: flush the file to disk before it is moved into place
+        sync_dir: also fsync the directory, callers writing many files can do this once at the end
+    """
+    dir = os.path.dirname(path)
+    tmp_dir = '%s/%s/' % (settings.XML_STORAGE_LOCATION, XML_TEMP_DIR)
+    ensure_xml_dir(tmp_dir)
+    try:
+        fd, tmp_path = tempfile.mkstemp(dir=tmp_dir, suffix='.tmp')
+    except FileNotFoundError:  # Directory was removed since it was cached
+        _known_dirs.discard(tmp_dir)
+        ensure_xml_dir(tmp_dir)
+        fd, tmp_path = tempfile.mkstemp(dir=tmp_dir, suffix='.tmp')
+    try:
+        os.fchmod(fd, XML_FILE_MODE)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+            if fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+    if fsync and sync_dir:
+        fsync_dir(dir)
+
+
+def write_loan_xml(loan, client, branch, references, force=False, sync_dir=True, fingerprint_index=None):
+    """
+    Renders the proloan import XML for a loan and saves it in the branch folder
+    Rendering is skipped when the XML exists and its fingerprint hasn't changed, unless force is set
+    fingerprint_index: XmlFingerprintIndex of the branch, the caller saves it. Without it the index
+    is read and saved for this loan alone
+    Returns:
+        path of the XML file
+    """
     # Check for mandatory information
     req_on_loan = ['loan_number', 'date_paidout']
     for i in req_on_loan:
@@ -71,13 +551,22 @@ def create_xml(loan_id, journey_api_user, journey_api_password, template_objects
 
     try:
         # Get datamodel
-        data_model = json.loads(open(settings.BASE_DIR + '/templates/journey_datamodel.json').read())
+        data_model = utils.datamodel_registry.get(settings.BASE_DIR + '/templates/journey_datamodel.json', models_key='models')
 
-        address_province_types = data_model['models']['address']['fields']['province']['options']
-        address_province = address_province_types[client.address_physical.province]['display']
-        marital_status_types = data_model['models']['client']['fields']['marital_status']['options']
+        codes = get_code_translator(data_model)
+        codes.validate([
+            ('province', 'client.address_physical.province', getattr(client.address_physical, 'province', None), True),
+            ('marital_status', 'client.marital_status', getattr(client, 'marital_status', None), False),
+            ('payment_method', 'loan.payout_method.payout_type', getattr(loan.payout_method, 'payout_type', None), True),
+            ('payment_method', 'loan.repayment_method.repayment_type',
+             getattr(loan.repayment_method, 'repayment_type', None), True),
+            ('instalment_frequency', 'loan.product.instalment_frequency',
+             getattr(loan.product, 'instalment_frequency', None), True),
+        ])
+
+        address_province = codes.province[client.address_physical.province]
         if getattr(client, 'marital_status', None) is not None:
-            marital_status = marital_status_types[client.marital_status]
+            marital_status = codes.marital_status[client.marital_status]
         else:
             marital_status = ''
 
@@ -91,7 +580,6 @@ def create_xml(loan_id, journey_api_user, journey_api_password, template_objects
         except Exception:
             note_date = ''
 
-        reference_relation_options = data_model['models']['reference']['fields']['relation']['options']
         if not loan.repayment_method.default_date_adj:
             payday_shift = "B"
         elif loan.repayment_method.default_date_adj['key'] == 1:
@@ -99,20 +587,19 @@ def create_xml(loan_id, journey_api_user, journey_api_password, template_objects
         else:
             payday_shift = "A"
 
-        allps_paymentstream_options = data_model['models']['repayment_method']['fields']['allps_pmt_stream']['options']
+        allps_paymentstream_options = data_model.options['repayment_method']['allps_pmt_stream']
         allps_paymentstream_string = loan.repayment_method.allps_pmt_stream if loan.repayment_method.allps_pmt_stream else ''
-        payout_method_type = payment_method_types[loan.payout_method.payout_type]
-        repayment_method_type = payment_method_types[loan.repayment_method.repayment_type]
+        payout_method_type = codes.payment_method[loan.payout_method.payout_type]
+        repayment_method_type = codes.payment_method[loan.repayment_method.repayment_type]
 
         try:
-            bank_account_type = bank_account_types[loan.repayment_bank_account.acc_type]
+            bank_account_type = codes.bank_account[loan.repayment_bank_account.acc_type]
         except Exception:
             bank_account_type = None
 
         loan_cost = loan.product.all_instalment_service_exc_vat + loan.product.all_instalment_initiation_exc_vat
         if loan.product.all_instalment_discount_exc_vat is not None:
             loan_cost += loan.product.all_instalment_discount_exc_vat
-        instalment_frequency_types = data_model['models']['product']['fields']['instalment_frequency']['options']
 
         allps_platform_id = ''
         if loan.repayment_method.allps_pmt_stream in ['NAEDO', 'EFT', 'SEFT']:
@@ -149,16 +636,31 @@ def create_xml(loan_id, journey_api_user, journey_api_password, template_objects
             client_street_address += '\n' + client.address_physical.city
         client_street_address += '\n' + address_province
 
+    dir = xml_branch_dir(branch)
+    path = '%s/%s.xml' % (dir, loan.id)
+    save_index = fingerprint_index is None
+    try:
+        fingerprint = xml_fingerprint(loan, client, branch, references, data_model)
+        if save_index:
+            fingerprint_index = XmlFingerprintIndex(branch)
+    except Exception as e:
+        logger.error('Error computing XML fingerprint: ' + str(e))
+        fingerprint = None
+    if not force and fingerprint is not None and os.path.isfile(path) \
+            and fingerprint_index.get(loan.id) == fingerprint:
+        logger.info("XML is up to date: " + path)
+        return path
+
     try:
         setattr(loan, 'client', client)
         context = {
             'loan': loan,
             'branch': branch,
-            'datamodel': data_model,
+            'datamodel': data_model.data,
             'client_postal_address': client_postal_address,
             'client_street_address': client_street_address,
             'loan_origination_date': loan_origination_date,
-            'instalment_frequency': instalment_frequency_types[loan.product.instalment_frequency],
+            'instalment_frequency': codes.instalment_frequency[loan.product.instalment_frequency],
             'address_province': address_province,
             'client_created_date': client_created_date,
             'paidout_date': paidout_date,
@@ -171,33 +673,67 @@ def create_xml(loan_id, journey_api_user, journey_api_password, template_objects
             'bank_account_type': bank_account_type,
             'allps_platform_id': allps_platform_id,
             'allps_paymentstream': allps_paymentstream_string,
-            'relation_types': reference_relation_options,
+            'relation_types': codes.relation,
             'references': references,
             'loan_repayment_method': loan_repayment_method
         }
-        # Write XML to file
-        dir = '%s/%s/%s/' % (settings.XML_STORAGE_LOCATION, branch.company.id, branch.id)
-        ensure_dir_exists(dir)
-        path = '%s/%s.xml' % (dir, loan.id)
         # Render XML from template
-        pretty_print = lambda data: '\n'.join(
-            [line for line in parseString(data).toprettyxml(indent=' ' * 2).split('\n') if line.strip()])
-        template = loader.get_template('proloan_import.xml')
-        xml_string = template.render(context)
-        xml_string_encoded = xml_string
-        xml_parsed = pretty_xml.parseString(xml_string_encoded)
-        xml_pretty = xml_parsed.toprettyxml()
-        final_xml = pretty_print(xml_pretty)  # Removes blank lines
+        xml_string = get_xml_template().render(context)
+        final_xml = render_pretty_xml(xml_string)  # Removes blank lines
         # If XML exists log a note
         if os.path.isfile(path):
             logger.info("XML already exists and will be updated now.")
 
         # Write XML to file
-        with open(path, 'wb') as f:
-            f.write(final_xml.encode('ascii', 'ignore'))  # might encode to byte since python 3.7
-            f.close()
-            utils.set_permissions(path)
-            logger.info("XML successfully saved to file: " + path)
+        final_xml = final_xml.encode('ascii', 'ignore')  # might encode to byte since python 3.7
+        ensure_xml_dir(dir)
+        try:
+            write_file_atomic(path, final_xml, sync_dir=sync_dir)
+        except FileNotFoundError:  # Directory was removed since it was cached
+            _known_dirs.discard(dir)
+            ensure_xml_dir(dir)
+            write_file_atomic(path, final_xml, sync_dir=sync_dir)
+        logger.info("XML successfully saved to file: " + path)
+        if fingerprint is not None:
+            fingerprint_index.set(loan.id, fingerprint)
+            if save_index:
+                fingerprint_index.save()
     except Exception as e:
         logger.error('Error rendering XML template: ' + str(e))
         raise Exception('Error rendering XML template: ' + str(e))
+    return path
+
+
+@app.task(bind=True, serializer='json')
+def export_object_csv(self, select, model, filters, order_by, rename_fields, instance_name, user_id, user_email, limit=0, summarize_array=[], rollup=False):
+    """
+    Exports a get_object query to a csv on s3 (mysql_utils.save_object_csv) and emails the link to user_email
+    once the upload is done. Progress is reported as the PROGRESS state with the number of rows written
+    """
+    # mysql_utils imports this module to queue the task
+    from red_fin.mysql_utils import save_object_csv
+
+    def progress(row_count):
+        if self.request.id:
+            self.update_state(state='PROGRESS', meta={'rows': row_count})
+
+    url = 'temp/%s_%s.csv' % (user_email, model)
+    uploaded = False
+    try:
+        uploaded = save_object_csv(select, model, filters, order_by, rename_fields, instance_name, user_id, url,
+                                   limit, summarize_array, rollup, progress=progress)
+    except Exception as e:
+        logger.error('CSV export failed: ' + str(e))
+
+    if uploaded:
+        content = 'Click the link to open your csv: \n\r %s/document/%s' % (settings.LOCAL_WEB_SERVER, url)
+        email(content=content,
+            subject='Query table CSV is ready',
+            to_address=user_email,
+            from_address='no-reply@modalityapps.com')
+    else:
+        email(content='CSV export failed',
+            subject='CSV export failed',
+            to_address=user_email,
+            from_address='no-reply@modalityapps.com')
+    return uploaded
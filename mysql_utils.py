@@ -1,319 +1,923 @@
 import simplejson as json
 import logging
+import base64
+import csv
 import datetime
+import io
 import os
 import re
+import tempfile
+import threading
+import time
+import weakref
 import mysql.connector as mysql
+from mysql.connector import FieldType
 
 from red_fin import settings
 from accounts.models import CustomUser
 from red_fin import mysql_models
 from django.apps import apps
-from collections import OrderedDict
+from collections import OrderedDict, deque, namedtuple
+from contextlib import contextmanager
 from pytz import timezone
-from red_fin.tasks import email
-from red_fin.s3_bucket_utils import s3_save_csv
+from red_fin.tasks import export_object_csv
+from red_fin.s3_bucket_utils import s3_save_stream, S3_MULTIPART_PART_SIZE
+from red_fin.utils import datamodel_registry, LRUCache
 
 logger = logging.getLogger('dashboard')
 get_model = apps.get_model
 
 local_tz = timezone(settings.TIME_ZONE)
 
+# Connection pool limits, a tenant can be given its own cap in MYSQL_POOL_TENANT_CAPS {instance_name: size}
+MYSQL_POOL_SIZE = getattr(settings, 'MYSQL_POOL_SIZE', 5)
+MYSQL_POOL_IDLE_TIMEOUT = getattr(settings, 'MYSQL_POOL_IDLE_TIMEOUT', 300)
+MYSQL_POOL_CHECKOUT_TIMEOUT = getattr(settings, 'MYSQL_POOL_CHECKOUT_TIMEOUT', 30)
+# Connections used within this many seconds are handed out again without a ping
+MYSQL_POOL_PING_INTERVAL = getattr(settings, 'MYSQL_POOL_PING_INTERVAL', 5)
+MYSQL_POOL_TENANT_CAPS = getattr(settings, 'MYSQL_POOL_TENANT_CAPS', {})
+# Rows fetched per round trip by the streaming functions
+MYSQL_STREAM_BATCH_SIZE = getattr(settings, 'MYSQL_STREAM_BATCH_SIZE', 2000)
+# Number of query shapes kept by the query plan cache
+MYSQL_QUERY_PLAN_CACHE_SIZE = getattr(settings, 'MYSQL_QUERY_PLAN_CACHE_SIZE', 512)
+# Prepare parameterized statements server side and keep them per pooled connection
+MYSQL_PREPARED_STATEMENTS = getattr(settings, 'MYSQL_PREPARED_STATEMENTS', False)
+MYSQL_PREPARED_STATEMENTS_PER_CONNECTION = getattr(settings, 'MYSQL_PREPARED_STATEMENTS_PER_CONNECTION', 32)
+# Optional result cache for dashboard queries, MYSQL_RESULT_CACHE_TTLS sets the seconds per model {model: ttl}
+MYSQL_RESULT_CACHE_ENABLED = getattr(settings, 'MYSQL_RESULT_CACHE_ENABLED', False)
+MYSQL_RESULT_CACHE_TTL = getattr(settings, 'MYSQL_RESULT_CACHE_TTL', 60)
+MYSQL_RESULT_CACHE_TTLS = getattr(settings, 'MYSQL_RESULT_CACHE_TTLS', {})
+MYSQL_RESULT_CACHE_SIZE = getattr(settings, 'MYSQL_RESULT_CACHE_SIZE', 1000)
+MYSQL_RESULT_CACHE_MAX_BYTES = getattr(settings, 'MYSQL_RESULT_CACHE_MAX_BYTES', 128 * 1024 * 1024)
+
+
 def default(o):
     if isinstance(o, (datetime.date, datetime.datetime)):
         return o.isoformat()
 
-# Make mysql query to get the objects
-def get_object(select, model, filters, order_by, rename_fields, instance_name, user_id, limit=0, user_email=False, remove_id=False, generate_sql=False, summarize_array=[], rollup=False):
+
+def mysql_connect(instance_name):
+    """
+    Opens a new connection to the instance database
+    Args:
+        instance_name: database name of the mobiloan instance
+    """
+    return mysql.connect(
+        host = "***",
+        user = "***",
+        passwd = "***",
+        database = instance_name
+    )
+
+
+class MysqlConnectionPool(object):
+    """
+    Bounded pool of connections for one instance database
+    Idle connections are closed after idle_timeout seconds, expired ones are evicted on every acquire and release.
+    Connections idle for longer than ping_interval seconds are pinged before they are handed out again
+    Open transactions are rolled back on release. Only sql built by this module runs on pooled connections,
+    user written sql can change session state and gets its own connection (raw_connection)
+    """
+
+    def __init__(self, instance_name, size=MYSQL_POOL_SIZE, idle_timeout=MYSQL_POOL_IDLE_TIMEOUT,
+                 checkout_timeout=MYSQL_POOL_CHECKOUT_TIMEOUT, ping_interval=MYSQL_POOL_PING_INTERVAL):
+        self.instance_name = instance_name
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.checkout_timeout = checkout_timeout
+        self.ping_interval = ping_interval
+        self._idle = deque()  # (connection, last used time), most recently used on the right
+        self._slots = threading.BoundedSemaphore(size)
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        if not self._slots.acquire(timeout=self.checkout_timeout):
+            raise Exception('No free MySQL connections for %s (pool size %s)' % (self.instance_name, self.size))
+        try:
+            self._evict_expired()
+            while True:
+                with self._lock:
+                    if not self._idle:
+                        break
+                    conn, last_used = self._idle.pop()
+                idle_for = time.time() - last_used
+                if idle_for < self.idle_timeout and (idle_for < self.ping_interval or self._is_healthy(conn)):
+                    return conn
+                self._close(conn)
+            return mysql_connect(self.instance_name)
+        except Exception:
+            self._slots.release()
+            raise
+
+    def release(self, conn, discard=False):
+        try:
+            if discard or conn.unread_result or not conn.is_connected():
+                self._close(conn)
+            else:
+                if conn.in_transaction:
+                    conn.rollback()
+                with self._lock:
+                    self._idle.append((conn, time.time()))
+        except Exception:
+            self._close(conn)
+        finally:
+            self._slots.release()
+        self._evict_expired()
+
+    @contextmanager
+    def connection(self):
+        conn = self.acquire()
+        try:
+            yield conn
+        except BaseException:
+            self.release(conn, discard=True)
+            raise
+        self.release(conn)
+
+    def _evict_expired(self):
+        # The least recently used connections are on the left, acquire only ever takes from the right
+        expired = []
+        with self._lock:
+            cutoff = time.time() - self.idle_timeout
+            while self._idle and self._idle[0][1] <= cutoff:
+                expired.append(self._idle.popleft()[0])
+        for conn in expired:
+            self._close(conn)
+
+    def close_idle(self):
+        with self._lock:
+            idle, self._idle = self._idle, deque()
+        for conn, last_used in idle:
+            self._close(conn)
+
+    @staticmethod
+    def _is_healthy(conn):
+        try:
+            conn.ping(reconnect=False)
+            return True
+        except Exception:
+            return False
+
+    @staticmethod
+    def _close(conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+
+_connection_pools = {}
+_connection_pools_lock = threading.Lock()
+
+
+def get_connection_pool(instance_name):
+    """
+    Returns the shared connection pool for an instance database, creating it on first use
+    Args:
+        instance_name: database name of the mobiloan instance
+    """
+    pool = _connection_pools.get(instance_name)
+    if pool is None:
+        with _connection_pools_lock:
+            pool = _connection_pools.get(instance_name)
+            if pool is None:
+                size = MYSQL_POOL_TENANT_CAPS.get(instance_name, MYSQL_POOL_SIZE)
+                pool = _connection_pools[instance_name] = MysqlConnectionPool(instance_name, size=size)
+    return pool
+
+
+@contextmanager
+def raw_connection(instance_name):
+    """
+    Unpooled connection for user written sql, which can change session state (USE, SET, LOCK TABLES,
+    temporary tables) that must not carry over to other queries. Uncommitted changes are rolled back on close
+    """
+    db = mysql_connect(instance_name)
     try:
-        # load in the datamodel that was created with 'datamodel_script' task (in readme)
-        path = os.path.join(settings.STATIC_ROOT, "app", "dist", "assets", "mysql_datamodel.json")
-        f = open(path,'r')
-        datamodel = json.loads(f.read())
-        f.close()
-        join = ""
-        filter_str = ""
-        group_by_str = ""
-        headers = []
-
-        # Prevent bugs when there is only 1 or no filters
+        yield db
+    finally:
+        MysqlConnectionPool._close(db)
+
+
+@contextmanager
+def user_connection(instance_name, user_id, pooled=True):
+    """
+    Connection for a user's query. Its id is stored on the user only while the query runs,
+    so kill_query can't hit another user's query once the connection goes back to the pool
+    Args:
+        pooled: False for user written sql, see raw_connection
+    """
+    connection = get_connection_pool(instance_name).connection() if pooled else raw_connection(instance_name)
+    with connection as db:
+        CustomUser.objects.filter(id=user_id).update(mysql_connection_id=db.connection_id)
         try:
-            if filters[0].__len__() == 1:
-                filters = []
-        except:
-            filters = []
-
-        # only run if there are no nested fields to select and you want to only output the raw sql
-        if not select[model]['children'] and generate_sql:
-            sql = "SELECT "
-            index = 0
-            for field in select[model]['fields']:
-                headers.append(field)
-                if index == 0: sql += "%s" % (field)
-                else: sql += ", %s" % (field)
-                index += 1
-        elif summarize_array.__len__() >= 1:
-            if generate_sql:
-                sql = "SELECT "
+            yield db
+        finally:
+            CustomUser.objects.filter(id=user_id).update(mysql_connection_id='')
+
+
+_prepared_cursors = weakref.WeakKeyDictionary()
+_prepared_cursors_lock = threading.Lock()
+
+
+def execute_sql(db, sql, params=None, buffered=None):
+    """
+    Executes sql on a connection and returns the cursor, close it with close_cursor
+    With MYSQL_PREPARED_STATEMENTS parameterized statements are prepared once per connection and
+    reused by later calls with the same query shape
+    Args:
+        db: connection from the pool
+        sql: sql with %s placeholders
+        params: values for the placeholders
+        buffered: False to read the result from the server as it is fetched
+    """
+    if params and MYSQL_PREPARED_STATEMENTS:
+        with _prepared_cursors_lock:
+            cursors = _prepared_cursors.setdefault(db, OrderedDict())
+        cursor = cursors.pop(sql, None)
+        if cursor is None:
+            cursor = db.cursor(prepared=True)
+        cursors[sql] = cursor
+        while len(cursors) > MYSQL_PREPARED_STATEMENTS_PER_CONNECTION:
+            cursors.popitem(last=False)[1].close()
+    else:
+        cursor = db.cursor(buffered=buffered)
+    cursor.execute(sql, params or None)
+    return cursor
+
+
+def close_cursor(db, cursor):
+    # Prepared statements stay open for the next query on this connection
+    if cursor not in _prepared_cursors.get(db, {}).values():
+        cursor.close()
+
+
+query_plan_cache = LRUCache(maxsize=MYSQL_QUERY_PLAN_CACHE_SIZE)
+
+
+def _result_size(value):
+    return len(value) if isinstance(value, str) else 64
+
+
+class QueryResultCache(object):
+    """
+    Caches query results per instance, sql, parameter values and permission scope
+    Every table has a version that is part of the key, invalidating a table bumps its version so
+    results that read from it are never returned again and age out of the LRU
+    """
+
+    def __init__(self, maxsize=MYSQL_RESULT_CACHE_SIZE, maxbytes=MYSQL_RESULT_CACHE_MAX_BYTES):
+        self._cache = LRUCache(maxsize=maxsize, maxweight=maxbytes, weigher=_result_size)
+        self._versions = {}  # (instance_name, table or None for the whole instance): version
+        self._lock = threading.Lock()
+
+    def key(self, instance_name, sql, params, tables, scope):
+        with self._lock:
+            versions = tuple(self._versions.get((instance_name, table), 0) for table in [None] + sorted(tables))
+        return (instance_name, ' '.join(sql.split()), tuple(params), scope, versions)
+
+    def get(self, key):
+        return self._cache.get(key)
+
+    def set(self, key, value, model):
+        self._cache.set(key, value, ttl=MYSQL_RESULT_CACHE_TTLS.get(model, MYSQL_RESULT_CACHE_TTL))
+
+    def invalidate(self, instance_name, table=None):
+        with self._lock:
+            self._versions[(instance_name, table)] = self._versions.get((instance_name, table), 0) + 1
+
+    def clear(self):
+        self._cache.clear()
+
+    def stats(self):
+        stats = self._cache.stats()
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = float(stats['hits']) / lookups if lookups else 0.0
+        return stats
+
+
+query_result_cache = QueryResultCache()
+
+
+def invalidate_cached_results(instance_name, table=None):
+    """
+    Call when a table is known to have changed so cached dashboard results that read from it are dropped
+    Args:
+        instance_name: database name of the mobiloan instance
+        table: table that changed, None drops everything cached for the instance
+    """
+    query_result_cache.invalidate(instance_name, table)
+
+
+def get_mysql_datamodel():
+    """
+    Returns the datamodel that was created with 'datamodel_script' task, cached by datamodel_registry
+    """
+    return datamodel_registry.get(os.path.join(settings.STATIC_ROOT, "app", "dist", "assets", "mysql_datamodel.json"))
+
+
+QueryPlan = namedtuple('QueryPlan', ['sql', 'param_specs', 'tables'])
+
+# Filter operators that compare the column to the filter value
+FILTER_COMPARISONS = {
+    "Greater than or equal": " >= %s",
+    "Greater than": " > %s",
+    "Less than": " < %s",
+    "Not equal to": " != %s",
+}
+
+
+def select_tables(select, model):
+    """
+    Returns the tables a select tree reads from
+    """
+    tables = set([model])
+    children = list((select[model]['children'] or {}).values())
+    while children:
+        child = children.pop()
+        tables.add(child['model'])
+        children.extend((child['children'] or {}).values())
+    return tables
+
+
+def normalize_filters(filters):
+    # Prevent bugs when there is only 1 or no filters
+    try:
+        if filters[0].__len__() == 1:
+            return []
+    except:
+        return []
+    return filters
+
+
+def compile_filters(filters):
+    """
+    Builds the where conditions for the query builder filters with %s placeholders for the filter values
+    Args:
+        filters: normalized list of filters
+    Returns:
+        (conditions, param_specs) where param_specs is a list of (filter index, bind kind), see bind_filter_params
+    """
+    conditions = ""
+    param_specs = []
+    index = 0
+    for query in filters:
+        index += 1
+        if index == 1:
+            if index < filters.__len__():
+                if filters[index]['where_operator'] == 'OR':
+                    conditions += '('
+        else:
+            conditions += ' %s ' % (query['where_operator'])
+            if index < filters.__len__():
+                if (filters[index-1]['where_operator'] == 'AND') and (filters[index]['where_operator'] == 'OR'):
+                    conditions += '('
+        column = query['table'] + '.' + query['field']
+        conditions += column
+        if query["operator"] == "Equals":
+            if query["type"] in ["date", "datetime"]:
+                conditions += " >= %%s AND %s < %%s" % column
+                param_specs += [(index-1, 'value'), (index-1, 'date_plus_2')]
             else:
-                sql = "SELECT " % model
-            group_by_str = ' GROUP BY '
-            for field in summarize_array:
-                headers.append("%s_%s" % (field['table'], field['field']))
-                sql += "%s.%s AS %s_%s, " % (field['table'], field['field'], field['table'], field['field'])
-                group_by_str += "%s_%s, " % (field['table'], field['field'])
-            for field in select[model]['fields']:
-                header = "%s_%s" % (model, field)
-                if header in headers:
-                    continue
-                if datamodel[model]['fields'][field]['type'] == 'number':
-                    sql += "sum(%s.%s) AS %s_%s_sum, " % (model, field, model, field)
-                else:
-                    sql += "count(%s.%s) AS %s_%s_count, " % (model, field, model, field)
-            sql = sql[:-2]
-            group_by_str = group_by_str[:-2]
-        elif generate_sql:
-            sql = "SELECT "
-            index = 0
+                conditions += " = %s"
+                param_specs.append((index-1, 'value'))
+        elif query["operator"] == "Contains":
+            conditions += " LIKE %s"
+            param_specs.append((index-1, 'contains'))
+        elif query["operator"] == "Less than or equal":
+            conditions += " <= %s"
+            if query["type"] in ["date", "datetime"]:
+                param_specs.append((index-1, 'date_plus_1'))
+            else:
+                param_specs.append((index-1, 'value'))
+        elif query["operator"] in FILTER_COMPARISONS:
+            conditions += FILTER_COMPARISONS[query["operator"]]
+            param_specs.append((index-1, 'value'))
+        elif query["operator"] == "Exists": conditions += " IS NOT NULL"
+        elif query["operator"] == "Does not exist": conditions += " IS NULL"
+        if (filters[index-1]['where_operator'] == 'OR') and (index == filters.__len__()):
+            conditions += ')'
+        else:
+            if (filters[index-1]['where_operator'] == 'OR') and (filters[index]['where_operator'] == 'AND'):
+                conditions += ')'
+    return conditions, param_specs
+
+
+def filter_value(query):
+    # Datetimes picked in the dashboard are in UTC, shift them to local time
+    if query["type"] in ["datetime"] and query.__len__() == 6:
+        return (datetime.datetime.strptime(query["value"][:19].replace('T',' '), '%Y-%m-%d %H:%M:%S') + datetime.timedelta(hours=2)).strftime('%Y-%m-%d %H:%M:%S')
+    return query["value"]
+
+
+def bind_filter_params(filters, param_specs):
+    """
+    Returns the values for the placeholders of compile_filters in order
+    """
+    params = []
+    for index, kind in param_specs:
+        value = filter_value(filters[index])
+        if kind == 'contains':
+            value = '%' + value + '%'
+        elif kind == 'date_plus_1':
+            value = (datetime.datetime.strptime(value[:10], '%Y-%m-%d') + datetime.timedelta(days=1)).strftime('%Y-%m-%d')
+        elif kind == 'date_plus_2':
+            value = (datetime.datetime.strptime(value[:10], '%Y-%m-%d') + datetime.timedelta(days=2)).strftime('%Y-%m-%d')
+        params.append(value)
+    return params
+
+
+def query_shape(select, model, filters, *args):
+    """
+    Key for the query plan cache, everything that changes the sql text but not the filter values
+    Keys aren't sorted because the order of the select tree is the column order of the result,
+    and the datamodel version is included because summarized plans are built from its field types
+    """
+    filter_shape = [(query['table'], query['field'], query['type'], query['operator'], query['where_operator'], query.__len__())
+                    for query in filters]
+    return json.dumps([get_mysql_datamodel().version, select[model], model, filter_shape] + list(args), default=str)
+
+
+def build_select_sql(select, model, rename_fields, generate_sql=False, summarize_array=[]):
+    """
+    Builds the select list and the joins of a get_object query
+    Args:
+        select: nested dict of the model, its fields and the children to join
+        model: table being queried
+    Returns:
+        (select_str, from_str, group_by_str) eg. ("SELECT loan.id AS loan_id", " FROM loan LEFT JOIN ...", "")
+    """
+    datamodel = get_mysql_datamodel()
+    group_by_str = ""
+    headers = []
+
+    # only run if there are no nested fields to select and you want to only output the raw sql
+    if not select[model]['children'] and generate_sql:
+        sql = "SELECT "
+        index = 0
+        for field in select[model]['fields']:
+            headers.append(field)
+            if index == 0: sql += "%s" % (field)
+            else: sql += ", %s" % (field)
+            index += 1
+    elif summarize_array.__len__() >= 1:
+        sql = "SELECT "
+        group_by_str = ' GROUP BY '
+        for field in summarize_array:
+            headers.append("%s_%s" % (field['table'], field['field']))
+            sql += "%s.%s AS %s_%s, " % (field['table'], field['field'], field['table'], field['field'])
+            group_by_str += "%s_%s, " % (field['table'], field['field'])
+        for field in select[model]['fields']:
+            header = "%s_%s" % (model, field)
+            if header in headers:
+                continue
+            if datamodel.field_types[model][field] == 'number':
+                sql += "sum(%s.%s) AS %s_%s_sum, " % (model, field, model, field)
+            else:
+                sql += "count(%s.%s) AS %s_%s_count, " % (model, field, model, field)
+        sql = sql[:-2]
+        group_by_str = group_by_str[:-2]
+    elif generate_sql:
+        sql = "SELECT "
+        index = 0
+        for field in select[model]['fields']:
+            if index == 0: sql += "%s.%s AS %s_%s" % (select[model]['label'], field, select[model]['label'], field)
+            else: sql += ", %s.%s AS %s_%s" % (select[model]['label'], field, select[model]['label'], field)
+            index += 1
+
+    else:
+        sql = "SELECT "
+        index = 0
+        if rename_fields:
             for field in select[model]['fields']:
                 if index == 0: sql += "%s.%s AS %s_%s" % (select[model]['label'], field, select[model]['label'], field)
                 else: sql += ", %s.%s AS %s_%s" % (select[model]['label'], field, select[model]['label'], field)
                 index += 1
-        
+        else: #getting belongs to fields
+            for field in select[model]['fields']:
+                if index == 0:
+                    if field == 'id': sql += "%s.%s AS id" % (select[model]['label'], field)
+                    else: sql += "%s.%s AS display" % (select[model]['label'], field)
+                else: 
+                    if field == 'id': sql += ", %s.%s AS id" % (select[model]['label'], field)
+                    else: sql += ", %s.%s AS display" % (select[model]['label'], field)
+                index += 1
+        if index == 0:
+            sql = sql[:-2]
+
+    if summarize_array.__len__() >= 1:
+        join_str, select_str, header_arr = get_all_values_summarized(select[model]['children'], model, datamodel, '', '', headers)
+    else:
+        join_str, select_str, header_arr = get_all_values(select[model]['children'], model, '', '', headers)
+    if generate_sql and sql == 'SELECT ':
+        select_str = select_str[2:]
+    return sql + select_str, " FROM %s%s" % (model, join_str), group_by_str
+
+
+def build_query_plan(select, model, filters, order_by, rename_fields, limit=0, generate_sql=False, summarize_array=[], rollup=False):
+    """
+    Builds the parameterized sql for a get_object query, the values are bound with bind_filter_params
+    Args:
+        select: nested dict of the model, its fields and the children to join
+        model: table being queried
+        filters: normalized list of filters from the query builder
+    Returns:
+        QueryPlan
+    """
+    select_str, from_str, group_by_str = build_select_sql(select, model, rename_fields, generate_sql, summarize_array)
+    conditions, param_specs = compile_filters(filters)
+    sql = select_str + from_str
+    if conditions:
+        sql += " WHERE " + conditions
+    if group_by_str:
+        sql += group_by_str
+        if rollup:
+            sql += " WITH ROLLUP"
+    elif filters.__len__() > 0:
+        if order_by:
+            sql += " ORDER BY %s" % order_by
         else:
-            sql = "SELECT "
-            index = 0
-            if rename_fields:
-                for field in select[model]['fields']:
-                    if index == 0: sql += "%s.%s AS %s_%s" % (select[model]['label'], field, select[model]['label'], field)
-                    else: sql += ", %s.%s AS %s_%s" % (select[model]['label'], field, select[model]['label'], field)
-                    index += 1
-            else: #getting belongs to fields
-                for field in select[model]['fields']:
-                    if index == 0:
-                        if field == 'id': sql += "%s.%s AS id" % (select[model]['label'], field)
-                        else: sql += "%s.%s AS display" % (select[model]['label'], field)
-                    else: 
-                        if field == 'id': sql += ", %s.%s AS id" % (select[model]['label'], field)
-                        else: sql += ", %s.%s AS display" % (select[model]['label'], field)
-                    index += 1
-            if index == 0:
-                sql = sql[:-2]
+            sql += " ORDER BY %s.row_num DESC" % model
+    if limit:
+        sql += " LIMIT %s"
+    return QueryPlan(sql, param_specs, select_tables(select, model))
+
+
+def build_object_sql(select, model, filters, order_by, rename_fields, limit=0, generate_sql=False, summarize_array=[], rollup=False):
+    """
+    Returns the QueryPlan and its parameter values for a get_object query
+    The sql for a query shape is only built once and then reused from the query plan cache
+    """
+    filters = normalize_filters(filters)
+    key = query_shape(select, model, filters, order_by, rename_fields, bool(limit), generate_sql, summarize_array, rollup)
+    plan = query_plan_cache.get(key)
+    if plan is None:
+        plan = build_query_plan(select, model, filters, order_by, rename_fields, limit, generate_sql, summarize_array, rollup)
+        query_plan_cache.set(key, plan)
+    params = bind_filter_params(filters, plan.param_specs)
+    if limit:
+        params.append(int(limit))
+    return plan, params
+
+
+def sql_literal(value):
+    if isinstance(value, (int, float)):
+        return str(value)
+    return "'%s'" % str(value).replace('\\', '\\\\').replace("'", "\\'")
 
-        index = 0
-        if filters.__len__() > 0:
-            where_operators = list(map(lambda x : x['where_operator'], filters))
-            for query in filters:
-                index += 1
-                if index == 1:
-                    filter_str += " WHERE "
-                    if index < filters.__len__():
-                        if filters[index]['where_operator'] == 'OR':
-                            filter_str += '('
-                else:
-                    filter_str += ' %s ' % (query['where_operator'])
-                    if index < filters.__len__():
-                        if (filters[index-1]['where_operator'] == 'AND') and (filters[index]['where_operator'] == 'OR'):
-                            filter_str += '('
-                if generate_sql:
-                    filter_str += '' + query['table'] + '.' + query['field']
-                else:
-                    filter_str += '' + query['table'] + '.' + query['field']
-                if query["type"] in ["datetime"] and query.__len__() == 6:
-                    query['value'] = (datetime.datetime.strptime(query["value"][:19].replace('T',' '), '%Y-%m-%d %H:%M:%S') + datetime.timedelta(hours=2)).strftime('%Y-%m-%d %H:%M:%S')
-                if query["operator"] == "Equals":
-                    if query["type"] in ["date", "datetime"]:
-                        temp_date = datetime.datetime.strptime(query["value"][:10], '%Y-%m-%d') + datetime.timedelta(days=2)
-                        filter_str += " >= '%s' AND %s.%s < '%s'" % (query["value"], query['table'], query['field'], temp_date.strftime('%Y-%m-%d'))
-                    else:
-                        filter_str += " = '" + query["value"] + "'"
-                elif query["operator"] == "Contains": filter_str += " LIKE '%%" + query["value"] + "%%'"
-                elif query["operator"] == "Greater than or equal": filter_str += " >= '" + query["value"] + "'"
-                elif query["operator"] == "Less than or equal":
-                    if query["type"] in ["date", "datetime"]:
-                        temp_date = datetime.datetime.strptime(query["value"][:10], '%Y-%m-%d') + datetime.timedelta(days=1)
-                        filter_str += " <= '%s'" % temp_date.strftime('%Y-%m-%d')
-                    else:
-                        filter_str += " <= '" + query["value"] + "'"
-                elif query["operator"] == "Greater than": filter_str += " > '" + query["value"] + "'"
-                elif query["operator"] == "Less than": filter_str += " < '" + query["value"] + "'"
-                elif query["operator"] == "Not equal to": filter_str += " != '" + query["value"] + "'"
-                elif query["operator"] == "Exists": filter_str += " IS NOT NULL"
-                elif query["operator"] == "Does not exist": filter_str += " IS NULL"
-                if (filters[index-1]['where_operator'] == 'OR') and (index == filters.__len__()):
-                    filter_str += ')'
-                else:
-                    if (filters[index-1]['where_operator'] == 'OR') and (filters[index]['where_operator'] == 'AND'):
-                        filter_str += ')'
 
-        if summarize_array.__len__() >= 1:
-            join_str, select_str, header_arr = get_all_values_summarized(select[model]['children'], model, datamodel, '', '', headers)
+def render_sql(sql, params):
+    """
+    Fills in the parameter values for displaying the sql (generate_sql), never execute the result
+    """
+    return sql % tuple(sql_literal(value) for value in params)
+
+
+def _format_datetime(value):
+    if value is None:
+        return None
+    return value.strftime('%Y-%m-%d %H:%M:%S')
+
+
+def column_converters(description):
+    """
+    Picks a converter per column once from the cursor description instead of type checking every value
+    Returns None when no column needs converting
+    Args:
+        description: cursor.description of the executed query
+    """
+    converters = []
+    for column in description:
+        if column[1] in (FieldType.DATETIME, FieldType.TIMESTAMP):
+            converters.append(_format_datetime)
         else:
-            join_str, select_str, header_arr = get_all_values(select[model]['children'], model, '', '', headers)
-        if generate_sql and sql == 'SELECT ':
-            select_str = select_str[2:]
-        
-        sql = "%s%s FROM %s%s%s" % (sql, select_str, model, join_str, filter_str)
-        if group_by_str:
-            sql += group_by_str
-            if rollup:
-                sql += " WITH ROLLUP"
-        elif filters.__len__() > 0:
-            if order_by:
-                sql += " ORDER BY %s" % order_by
-            else:
-                sql += " ORDER BY %s.row_num DESC" % model
-        if limit:
-            sql += " LIMIT %s" % limit
+            converters.append(None)
+    if not any(converters):
+        return None
+    return converters
 
+
+def convert_row(row, converters):
+    if converters is None:
+        return row
+    return [value if converter is None else converter(value) for converter, value in zip(converters, row)]
+
+
+def iter_row_batches(cursor, batch_size=MYSQL_STREAM_BATCH_SIZE):
+    """
+    Reads an executed (unbuffered) cursor in batches so only one batch is held in memory
+    Yields lists of converted rows
+    """
+    converters = column_converters(cursor.description)
+    while True:
+        batch = cursor.fetchmany(batch_size)
+        if not batch:
+            break
+        yield [convert_row(row, converters) for row in batch]
+
+
+def rows_to_dicts(headers, rows, converters):
+    return [OrderedDict(zip(headers, convert_row(row, converters))) for row in rows]
+
+
+def stream_json_rows(sql, instance_name, user_id, batch_size=MYSQL_STREAM_BATCH_SIZE, params=None, pooled=True):
+    """
+    Runs sql on a server side cursor and yields the {"headers", "rows"} json in chunks,
+    meant to be handed to a StreamingHttpResponse. pooled=False for user written sql
+    An error before the first chunk is yielded as {"error"} json like get_object does,
+    after that the response has already started so it is logged and raised
+    """
+    started = False
+    try:
+        with user_connection(instance_name, user_id, pooled) as db:
+            cursor = execute_sql(db, sql, params, buffered=False)
+            headers = [x[0] for x in cursor.description]
+            started = True
+            yield '{"headers": %s, "rows": [' % json.dumps(headers)
+            separator = ''
+            for batch in iter_row_batches(cursor, batch_size):
+                yield separator + ', '.join(json.dumps(OrderedDict(zip(headers, row)), default=default) for row in batch)
+                separator = ', '
+            yield ']}'
+            close_cursor(db, cursor)
+    except Exception as e:
+        logger.error(str(e))
+        if started:
+            raise
+        yield json.dumps({'error': str(e)})
+
+
+def stream_object(select, model, filters, order_by, rename_fields, instance_name, user_id, limit=0, summarize_array=[], rollup=False, batch_size=MYSQL_STREAM_BATCH_SIZE):
+    """
+    Streaming version of get_object, yields the result json in chunks
+    eg. StreamingHttpResponse(stream_object(...), content_type='application/json')
+    """
+    try:
+        plan, params = build_object_sql(select, model, filters, order_by, rename_fields, limit, False, summarize_array, rollup)
+    except Exception as e:
+        logger.error(str(e))
+        yield json.dumps({'error': str(e)})
+        return
+    for chunk in stream_json_rows(plan.sql, instance_name, user_id, batch_size, params):
+        yield chunk
+
+
+def stream_raw_sql(raw_sql, instance_name, user_id, batch_size=MYSQL_STREAM_BATCH_SIZE):
+    """
+    Streaming version of get_raw_sql, yields the result json in chunks
+    """
+    return stream_json_rows(raw_sql, instance_name, user_id, batch_size, pooled=False)
+
+
+def get_object(select, model, filters, order_by, rename_fields, instance_name, user_id, limit=0, user_email=False, remove_id=False, generate_sql=False, summarize_array=[], rollup=False, cache_scope=None):
+    try:
+        plan, params = build_object_sql(select, model, filters, order_by, rename_fields, limit, generate_sql, summarize_array, rollup)
         if generate_sql:
-            return json.dumps({"sql": sql})
+            return json.dumps({"sql": render_sql(plan.sql, params)})
+        if user_email:
+            # The csv is built and emailed in the background
+            export_object_csv.delay(select, model, filters, order_by, rename_fields, instance_name, user_id, user_email,
+                                    limit, summarize_array, rollup)
+            return
+        # Users only share cached results when the caller passes the same permission scope for them
+        cache_key = None
+        if MYSQL_RESULT_CACHE_ENABLED and not user_email:
+            cache_key = query_result_cache.key(instance_name, plan.sql, params, plan.tables,
+                                               user_id if cache_scope is None else cache_scope)
+            json_content = query_result_cache.get(cache_key)
+            if json_content is not None:
+                return json_content
         # Get object model
-        rows = []
-        db = mysql.connect(
-            host = "***",
-            user = "***",
-            passwd = "***",
-            database = instance_name
-        )
-        cursor = db.cursor()
-        CustomUser.objects.filter(id=user_id).update(mysql_connection_id=db.connection_id)
-        cursor.execute(sql)
-        result = cursor.fetchall()
-        headers=[x[0] for x in cursor.description] #this will extract row headers
-        db.close()
-        for res in result:
-            temp_dict = OrderedDict()
-            for key in range(len(res)):
-                if isinstance(res[key], datetime.datetime):
-                    temp_dict[headers[key]] = res[key].strftime('%Y-%m-%d %H:%M:%S')
-                else:
-                    temp_dict[headers[key]] = res[key]
-            rows.append(temp_dict)
+        with user_connection(instance_name, user_id) as db:
+            cursor = execute_sql(db, plan.sql, params)
+            result = cursor.fetchall()
+            headers=[x[0] for x in cursor.description] #this will extract row headers
+            converters = column_converters(cursor.description)
+            close_cursor(db, cursor)
+        rows = rows_to_dicts(headers, result, converters)
+        result = {"headers":headers, "rows":rows}
 
-        if user_email:
-            url = 'temp/%s_%s.csv' % (user_email,model)
-            if s3_save_csv(headers, rows, url):
-                content = 'Click the link to open your csv: \n\r %s/document/%s' % (settings.LOCAL_WEB_SERVER, url)
-                email(content=content,
-                    subject='Query table CSV is ready',
-                    to_address=user_email,
-                    from_address='no-reply@modalityapps.com')
+        json_content = json.dumps(result,indent=1,default=default)
+        if cache_key is not None:
+            query_result_cache.set(cache_key, json_content, model)
+        return json_content
+    except Exception as e:
+        logger.error(str(e))
+        return json.dumps({'error': str(e)})
+
+
+def parse_page_order(order_by, model):
+    """
+    Returns (column, direction) of the sort for keyset paging, rows are sorted on row_num after the column
+    """
+    if not order_by:
+        return '%s.row_num' % model, 'DESC'
+    parts = order_by.split()
+    if ',' in order_by or len(parts) > 2 or (len(parts) == 2 and parts[1].upper() not in ['ASC', 'DESC']):
+        raise Exception('Paging can only be ordered by one column: %s' % order_by)
+    return parts[0], parts[1].upper() if len(parts) == 2 else 'ASC'
+
+
+def build_page_plan(select, model, filters, rename_fields, order_by, seek):
+    """
+    Builds the parameterized sql for one page of get_object_page
+    The filter values are followed by the seek values (sort key, row_num) when seek is set and then the page size
+    """
+    column, direction = parse_page_order(order_by, model)
+    row_num = '%s.row_num' % model
+    operator = '<' if direction == 'DESC' else '>'
+    select_str, from_str, group_by_str = build_select_sql(select, model, rename_fields)
+    conditions, param_specs = compile_filters(filters)
+    select_str += ", %s AS _page_row_num" % row_num
+    if column != row_num:
+        select_str += ", %s AS _page_key" % column
+    where = ['(%s)' % conditions] if conditions else []
+    if seek and column == row_num:
+        where.append("%s %s %%s" % (row_num, operator))
+    elif seek:
+        where.append("(%s %s %%s OR (%s = %%s AND %s %s %%s))" % (column, operator, column, row_num, operator))
+    sql = select_str + from_str
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    if column != row_num:
+        sql += " ORDER BY %s %s, %s %s LIMIT %%s" % (column, direction, row_num, direction)
+    else:
+        sql += " ORDER BY %s %s LIMIT %%s" % (row_num, direction)
+    return QueryPlan(sql, param_specs, select_tables(select, model))
+
+
+def encode_page_token(row):
+    return base64.urlsafe_b64encode(json.dumps(row, default=default).encode('utf-8')).decode('ascii')
+
+
+def decode_page_token(page_token):
+    try:
+        return json.loads(base64.urlsafe_b64decode(page_token.encode('ascii')).decode('utf-8'))
+    except Exception:
+        raise Exception('Invalid page token')
+
+
+def get_object_page(select, model, filters, rename_fields, instance_name, user_id, page_size=100, order_by=None, page_token=None):
+    """
+    Keyset paging for get_object, every page costs the same no matter how deep it is
+    Pass the next_page_token of the previous page to get the next one, it is null on the last page
+    Rows are ordered by order_by (one column, eg. "loan.date_created DESC") and then row_num,
+    or by row_num descending like get_object. The order column should not contain nulls
+    Returns:
+        json {"headers", "rows", "next_page_token"}
+    """
+    try:
+        filters = normalize_filters(filters)
+        seek = decode_page_token(page_token) if page_token else None
+        key = query_shape(select, model, filters, 'page', order_by, rename_fields, seek is not None)
+        plan = query_plan_cache.get(key)
+        if plan is None:
+            plan = build_page_plan(select, model, filters, rename_fields, order_by, seek is not None)
+            query_plan_cache.set(key, plan)
+        params = bind_filter_params(filters, plan.param_specs)
+        if seek is not None and 'key' in seek:
+            params += [seek['key'], seek['key'], seek['row_num']]
+        elif seek is not None:
+            params.append(seek['row_num'])
+        params.append(int(page_size))
+
+        with user_connection(instance_name, user_id) as db:
+            cursor = execute_sql(db, plan.sql, params)
+            result = cursor.fetchall()
+            headers = [x[0] for x in cursor.description]
+            converters = column_converters(cursor.description)
+            close_cursor(db, cursor)
+        # The last one or two columns are the sort key and row_num that go into the page token.
+        # The token takes them from the raw row, datetimes keep their microseconds (isoformat)
+        hidden = 2 if headers[-1] == '_page_key' else 1
+        rows = [convert_row(row, converters) for row in result]
+        next_page_token = None
+        if rows and len(rows) == int(page_size):
+            last = result[-1]
+            if hidden == 2:
+                next_page_token = encode_page_token({'key': last[-1], 'row_num': last[-2]})
             else:
-                email(content='CSV export failed',
-                    subject='CSV export failed',
-                    to_address=user_email,
-                    from_address='no-reply@modalityapps.com')
-            return
-        else:
-            result = {"headers":headers, "rows":rows}
-            
-            json_content = json.dumps(result,indent=1,default=default)
-            return json_content
+                next_page_token = encode_page_token({'row_num': last[-1]})
+        headers = headers[:-hidden]
+        result = {
+            "headers": headers,
+            "rows": [OrderedDict(zip(headers, row[:-hidden])) for row in rows],
+            "next_page_token": next_page_token
+        }
+        return json.dumps(result, indent=1, default=default)
     except Exception as e:
         logger.error(str(e))
-        db.close()
         return json.dumps({'error': str(e)})
 
 
+def save_object_csv(select, model, filters, order_by, rename_fields, instance_name, user_id, url, limit=0, summarize_array=[], rollup=False, progress=None):
+    """
+    Runs a get_object query and uploads the rows as a csv to media/<url> on s3, used by the export_object_csv task
+    Rows are read in batches from a server side cursor and spooled to a temporary file so memory stays flat.
+    The file is uploaded once the query is done, a slow upload can't stall the cursor past net_write_timeout
+    Args:
+        progress: optional callable, called with the number of rows written after each batch
+    """
+    plan, params = build_object_sql(select, model, filters, order_by, rename_fields, limit, False, summarize_array, rollup)
+    with tempfile.TemporaryFile() as f:
+        text = io.TextIOWrapper(f, encoding='utf-8', newline='')
+        writer = csv.writer(text, lineterminator='\n')
+        row_count = 0
+        with user_connection(instance_name, user_id) as db:
+            cursor = execute_sql(db, plan.sql, params, buffered=False)
+            writer.writerow([x[0] for x in cursor.description])
+            for batch in iter_row_batches(cursor):
+                writer.writerows(batch)
+                row_count += len(batch)
+                if progress is not None:
+                    progress(row_count)
+            close_cursor(db, cursor)
+        text.flush()
+        text.detach()
+        f.seek(0)
+        return s3_save_stream(iter(lambda: f.read(S3_MULTIPART_PART_SIZE), b''), 'media/' + url,
+                              content_type='text/csv')
+
+
 def get_raw_sql(raw_sql, instance_name, user_id):
     try:
-        rows = []
-        db = mysql.connect(
-            host = "***",
-            user = "***",
-            passwd = "***",
-            database = instance_name
-        )
-        cursor = db.cursor()
-        CustomUser.objects.filter(id=user_id).update(mysql_connection_id=db.connection_id)
-        cursor.execute(raw_sql)
-        result = cursor.fetchall()
-        headers=[x[0] for x in cursor.description] #this will extract row headers
-        db.close()
-        for res in result:
-            temp_dict = OrderedDict()
-            for key in range(len(res)):
-                if isinstance(res[key], datetime.datetime):
-                    temp_dict[headers[key]] = res[key].strftime('%Y-%m-%d %H:%M:%S')
-                else:
-                    temp_dict[headers[key]] = res[key]
-            rows.append(temp_dict)
+        with user_connection(instance_name, user_id, pooled=False) as db:
+            cursor = db.cursor()
+            cursor.execute(raw_sql)
+            result = cursor.fetchall()
+            headers=[x[0] for x in cursor.description] #this will extract row headers
+            converters = column_converters(cursor.description)
+            cursor.close()
+        rows = rows_to_dicts(headers, result, converters)
 
         result = {"rows":rows, "headers": headers}
             
         json_content = json.dumps(result,indent=1,default=default)
-        CustomUser.objects.filter(id=user_id).update(mysql_connection_id='')
         return json_content
     except Exception as e:
-        db.close()
         return json.dumps({'error': str(e)})
 
 
-def get_objects_count(model, filters, select, instance_name):
-    filter_str = ""
-    index = 0
+def get_objects_count(model, filters, select, instance_name, cache_scope=None, approximate=False, user_id=None):
+    """
+    Counts the rows of a get_object query
+    Only the tables the filters reference are joined, all joins are to-one so the others do not change the count
+    Args:
+        cache_scope: permission scope cached counts are shared within, defaults to user_id like get_object.
+            Counts are not cached when neither is given
+        approximate: estimate the count from the table statistics instead of counting, for very large tables
+    """
     try:
-        where_operators = list(map(lambda x : x['where_operator'], filters))
-        try:
-            if filters[0].__len__() == 1:
-                filters = []
-        except:
-            filters = []
-        for query in filters:
-            index += 1
-            if index == 1:
-                filter_str += " WHERE "
-                if index < filters.__len__():
-                    if filters[index]['where_operator'] == 'OR':
-                        filter_str += '('
+        filters = normalize_filters(filters)
+        conditions, param_specs = compile_filters(filters)
+        params = bind_filter_params(filters, param_specs)
+        join_str = get_required_joins(select[model]['children'], model, set(query['table'] for query in filters))
+        sql = "SELECT count(*) FROM %s%s" % (model, join_str)
+        if conditions:
+            sql += " WHERE " + conditions
+        cache_key = None
+        scope = user_id if cache_scope is None else cache_scope
+        if MYSQL_RESULT_CACHE_ENABLED and scope is not None:
+            cache_key = query_result_cache.key(instance_name, sql, params + [approximate], select_tables(select, model), scope)
+            count = query_result_cache.get(cache_key)
+            if count is not None:
+                return {"success": count}
+        with get_connection_pool(instance_name).connection() as db:
+            if approximate:
+                count = estimate_count(db, model, sql, params, conditions)
             else:
-                filter_str += ' %s ' % (query['where_operator'])
-                if index < filters.__len__():
-                    if (filters[index-1]['where_operator'] == 'AND') and (filters[index]['where_operator'] == 'OR'):
-                        filter_str += '('
-            filter_str += '' + query['table'] + '.' + query['field']
-            if query["operator"] == "Equals":
-                if query["type"] in ["date", "datetime"]:
-                    temp_date = datetime.datetime.strptime(query["value"][:10], '%Y-%m-%d') + datetime.timedelta(days=2)
-                    filter_str += " >= '%s' AND %s.%s < '%s'" % (query["value"], query['table'], query['field'], temp_date.strftime('%Y-%m-%d'))
-                else:
-                    filter_str += " = '" + query["value"] + "'"
-            elif query["operator"] == "Contains": filter_str += " LIKE '%%" + query["value"] + "%%'"
-            elif query["operator"] == "Greater than or equal":
-                filter_str += " >= '" + query["value"] + "'"
-            elif query["operator"] == "Less than or equal":
-                    if query["type"] in ["date", "datetime"]:
-                        temp_date = datetime.datetime.strptime(query["value"][:10], '%Y-%m-%d') + datetime.timedelta(days=1)
-                        filter_str += " <= '%s'" % temp_date.strftime('%Y-%m-%d')
-                    else:
-                        filter_str += " <= '" + query["value"] + "'"
-            elif query["operator"] == "Greater than": filter_str += " > '" + query["value"] + "'"
-            elif query["operator"] == "Less than": filter_str += " < '" + query["value"] + "'"
-            elif query["operator"] == "Not equal to": filter_str += " != '" + query["value"] + "'"
-            elif query["operator"] == "Exists": filter_str += " IS NOT NULL"
-            elif query["operator"] == "Does not exist": filter_str += " IS NULL"
-            if (filters[index-1]['where_operator'] == 'OR') and (index == filters.__len__()):
-                filter_str += ')'
-            else:
-                if (filters[index-1]['where_operator'] == 'OR') and (filters[index]['where_operator'] == 'AND'):
-                    filter_str += ')'
-
-        join_str, select_str, header_arr = get_all_values(select[model]['children'], model, '', '', [])
-        sql = "SELECT count(*) AS id FROM %s%s%s" % (model, join_str, filter_str)
-        # Get object model
-        model_name = model.title().replace('_','')
-        db = get_model("red_fin", model_name)
-        result = db.objects.using(instance_name).raw(sql)
-
-        for res in result:
-            temp_dict = res.__dict__
-        return {"success": temp_dict['id']}
+                cursor = execute_sql(db, sql, params)
+                count = cursor.fetchone()[0]
+                close_cursor(db, cursor)
+        if cache_key is not None:
+            query_result_cache.set(cache_key, count, model)
+        return {"success": count}
     except Exception as e:
         logger.error(str(e))
         return {"failed": str(e)}
 
 
+def estimate_count(db, model, sql, params, conditions):
+    """
+    Row estimate from information_schema for a whole table, or from the optimizer (EXPLAIN) when filtered
+    """
+    cursor = db.cursor()
+    try:
+        if not conditions:
+            cursor.execute("SELECT TABLE_ROWS FROM information_schema.TABLES WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s", (model,))
+            row = cursor.fetchone()
+            return int(row[0] or 0) if row else 0
+        cursor.execute("EXPLAIN " + sql, params or None)
+        columns = [x[0] for x in cursor.description]
+        for row in cursor.fetchall():
+            row = dict(zip(columns, row))
+            if row['table'] == model:
+                return int((row['rows'] or 0) * float(row.get('filtered') or 100) / 100)
+        return 0
+    finally:
+        cursor.close()
+
+
 def get_fields(model):
     fields_to_ignore = ['row_num', 'updated_at', 'password', 'field_ver', 'display', 'terms_acceptance', 'face_photo', 'id', 'webhook_trigger']
     embed_fields = ['agent_id','agent_commission_rule_id','area_id','branch_id','broadcast_id','cashbox_category_id','category_id','company_id','compuscan_id','document_type_id','employer_id','loan_insurance_id','loan_product_id','operator_id','payout_method_id','product_addon_type_id','purpose_id','repayment_method_id','role_id','transaction_category_id','worker_id']
@@ -356,6 +960,19 @@ def get_all_values(nested_dictionary, parent, join_str='', select_str='', header
         return '', '', header_arr
 
 
+def get_required_joins(nested_dictionary, parent, labels):
+    """
+    Same joins as get_all_values but only for the branches that lead to one of labels
+    """
+    join_str = ''
+    for key, value in (nested_dictionary or {}).items():
+        child_joins = get_required_joins(value['children'], value['label'], labels)
+        if value['label'] in labels or child_joins:
+            join_str += " LEFT JOIN %s AS %s ON %s.%s_id = %s.id" % (value['model'], value['label'], parent, value['label'], value['label'])
+            join_str += child_joins
+    return join_str
+
+
 def get_all_values_summarized(nested_dictionary, parent, datamodel, join_str='', select_str='', header_arr=[]):
     if nested_dictionary.__len__() > 0:
         for key, value in nested_dictionary.items():
@@ -363,7 +980,7 @@ def get_all_values_summarized(nested_dictionary, parent, datamodel, join_str='',
             for field in value['fields']:
                 if "%s_%s" % (value['label'], field) in header_arr:
                     continue
-                if datamodel[value['model']]['fields'][field]['type'] == 'number':
+                if datamodel.field_types[value['model']][field] == 'number':
                     header_arr.append("%s_%s_sum" % (value['label'], field))
                     select_str += ", sum(%s.%s) AS %s_%s_sum" % (value['label'], field, value['label'], field)
                 else:
@@ -378,15 +995,12 @@ def get_all_values_summarized(nested_dictionary, parent, datamodel, join_str='',
 
 def kill_query(conn_id, instance_name, user_id):
     try:
-        db = mysql.connect(
-            host = "***",
-            user = "***",
-            passwd = "***",
-            database = instance_name
-        )
-        cursor = db.cursor()
-        cursor.execute('KILL ' + conn_id)
-        db.close()
+        # Own connection so a cancel still gets through when the pool is exhausted.
+        # A killed pooled connection fails the query, which discards it from the pool
+        with raw_connection(instance_name) as db:
+            cursor = db.cursor()
+            cursor.execute('KILL ' + conn_id)
+            cursor.close()
         CustomUser.objects.filter(id=user_id).update(mysql_connection_id='')
         return json.dumps({'done': 'Query ' + conn_id + ' killed'})
     except Exception as e:
@@ -1,39 +1,133 @@
-import boto3
+import asyncio
 import csv
+import functools
+import gzip
+import hashlib
+import io
+import operator
+import os
+import queue
+import threading
 from . import settings
+from .utils import LRUCache
 from botocore.exceptions import ClientError
 from botocore.client import Config
+from concurrent.futures import ThreadPoolExecutor
 
-s3_client = boto3.client(
-    's3',
-    aws_access_key_id=settings.ACCESS_KEY_ID,
-    aws_secret_access_key=settings.ACCESS_SECRET_KEY,
-    config=Config(signature_version='s3v4'))
-s3_resource = boto3.resource(
-    's3',
-    aws_access_key_id=settings.ACCESS_KEY_ID,
-    aws_secret_access_key=settings.ACCESS_SECRET_KEY,
-    config=Config(signature_version='s3v4'))
+# Client connection pool, retries and timeouts
+S3_MAX_POOL_CONNECTIONS = getattr(settings, 'S3_MAX_POOL_CONNECTIONS', 50)
+S3_RETRY_MODE = getattr(settings, 'S3_RETRY_MODE', 'standard')
+S3_MAX_ATTEMPTS = getattr(settings, 'S3_MAX_ATTEMPTS', 5)
+S3_CONNECT_TIMEOUT = getattr(settings, 'S3_CONNECT_TIMEOUT', 10)
+S3_READ_TIMEOUT = getattr(settings, 'S3_READ_TIMEOUT', 60)
+
+# Threads the async functions run the blocking calls on, this bounds how many s3 calls run at once
+S3_ASYNC_WORKERS = getattr(settings, 'S3_ASYNC_WORKERS', 32)
+
+# The client and resource are only created when s3 is first used so importing this module stays cheap
+_s3_client = None
+_s3_client_lock = threading.Lock()
+_s3_resources = threading.local()
+
+
+def _s3_session_args():
+    return {
+        'aws_access_key_id': settings.ACCESS_KEY_ID,
+        'aws_secret_access_key': settings.ACCESS_SECRET_KEY,
+        'config': Config(signature_version='s3v4',
+                         max_pool_connections=S3_MAX_POOL_CONNECTIONS,
+                         retries={'mode': S3_RETRY_MODE, 'max_attempts': S3_MAX_ATTEMPTS},
+                         connect_timeout=S3_CONNECT_TIMEOUT,
+                         read_timeout=S3_READ_TIMEOUT)
+    }
+
+
+def get_s3_client():
+    """ .:e:.
+    s3 client shared by all threads (boto3 clients are thread safe), created on first use
+    """
+    global _s3_client
+    if _s3_client is None:
+        with _s3_client_lock:
+            if _s3_client is None:
+                import boto3
+                _s3_client = boto3.session.Session().client('s3', **_s3_session_args())
+    return _s3_client
+
+
+def get_s3_resource():
+    """ .:e:.
+    s3 resource for the current thread (boto3 resources are not thread safe), created on first use
+    """
+    resource = getattr(_s3_resources, 'resource', None)
+    if resource is None:
+        import boto3
+        resource = _s3_resources.resource = boto3.session.Session().resource('s3', **_s3_session_args())
+    return resource
+
+
+def __getattr__(name):
+    # s3_client and s3_resource used to be created at import time, keep them reachable for old imports
+    if name == 's3_client':
+        return get_s3_client()
+    if name == 's3_resource':
+        return get_s3_resource()
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+# Streaming uploads switch to a multipart upload above the threshold, s3 parts must be at least 5MB
+S3_MULTIPART_THRESHOLD = getattr(settings, 'S3_MULTIPART_THRESHOLD', 8 * 1024 * 1024)
+S3_MULTIPART_PART_SIZE = max(getattr(settings, 'S3_MULTIPART_PART_SIZE', 8 * 1024 * 1024), 5 * 1024 * 1024)
+S3_MULTIPART_WORKERS = getattr(settings, 'S3_MULTIPART_WORKERS', 4)
+# Rows serialised per write to the upload by s3_save_csv
+CSV_BATCH_ROWS = 1000
+# Streaming downloads, large files can be fetched as concurrent ranged gets
+S3_DOWNLOAD_CHUNK_SIZE = getattr(settings, 'S3_DOWNLOAD_CHUNK_SIZE', 1024 * 1024)
+S3_DOWNLOAD_PART_SIZE = getattr(settings, 'S3_DOWNLOAD_PART_SIZE', 8 * 1024 * 1024)
+S3_DOWNLOAD_WORKERS = getattr(settings, 'S3_DOWNLOAD_WORKERS', 4)
+# Concurrent requests for the batch copy functions
+S3_BATCH_WORKERS = getattr(settings, 'S3_BATCH_WORKERS', 16)
+# DeleteObjects takes at most 1000 keys per request
+S3_DELETE_BATCH_SIZE = 1000
+# Presigned urls are reused until S3_PRESIGNED_URL_REUSE_FRACTION of their lifetime has passed
+S3_PRESIGNED_URL_EXPIRY = getattr(settings, 'S3_PRESIGNED_URL_EXPIRY', 3600)
+S3_PRESIGNED_URL_REUSE_FRACTION = getattr(settings, 'S3_PRESIGNED_URL_REUSE_FRACTION', 0.5)
+S3_PRESIGNED_URL_CACHE_SIZE = getattr(settings, 'S3_PRESIGNED_URL_CACHE_SIZE', 10000)
+PRESIGNED_HTTP_METHODS = {
+    'get_object': 'GET',
+    'head_object': 'HEAD',
+    'put_object': 'PUT',
+    'delete_object': 'DELETE',
+}
 
 # TODO convert to classes and objects for better referencing
 
 
-def s3_presigned_url(path):
+presigned_url_cache = LRUCache(maxsize=S3_PRESIGNED_URL_CACHE_SIZE)
+
+
+def s3_presigned_url(path, expires_in=S3_PRESIGNED_URL_EXPIRY, method='get_object'):
     """ .:e:.
+    Signed urls are cached and handed out again until S3_PRESIGNED_URL_REUSE_FRACTION of expires_in has passed
     Args:
-        path:
+        path: File location inside s3
+        expires_in: seconds the url is valid for
+        method: s3 client method the url is for, see PRESIGNED_HTTP_METHODS
     """
     try:
         if path[0] == "/":
             path = path[1:]  # Cut away the preceding "/" so it saves to the correct location
-        url = s3_client.generate_presigned_url(
-            'get_object',
-            Params={
-                'Bucket': settings.BUCKET_NAME,
-                'Key': path
-            },
-            ExpiresIn=3600,
-            HttpMethod="GET")
+        key = (settings.BUCKET_NAME, path, method, expires_in)
+        url = presigned_url_cache.get(key)
+        if url is None:
+            url = get_s3_client().generate_presigned_url(
+                method,
+                Params={
+                    'Bucket': settings.BUCKET_NAME,
+                    'Key': path
+                },
+                ExpiresIn=expires_in,
+                HttpMethod=PRESIGNED_HTTP_METHODS[method])
+            presigned_url_cache.set(key, url, ttl=expires_in * S3_PRESIGNED_URL_REUSE_FRACTION)
 
         return url
     except Exception as e:
@@ -41,6 +135,17 @@ def s3_presigned_url(path):
         return 'error'
 
 
+def s3_presigned_urls(paths, expires_in=S3_PRESIGNED_URL_EXPIRY, method='get_object'):
+    """ .:e:.
+    Presigned urls for many files at once, eg. all the documents on a page
+    Args:
+        paths: File locations inside s3
+    Returns:
+        {path: url or 'error'}
+    """
+    return dict((path, s3_presigned_url(path, expires_in, method)) for path in paths)
+
+
 def s3_file_exists(url):
     """ .:e:.
     Check to see if the file exists on s3 bucket
@@ -50,7 +155,7 @@ def s3_file_exists(url):
     try:
         if url[0] == "/":
             url = url[1:]  # Cut away the preceding "/" so it saves to the correct location
-        s3_resource.Object(settings.BUCKET_NAME, url).load()
+        get_s3_resource().Object(settings.BUCKET_NAME, url).load()
     except ClientError as e:
         if e.response['Error']['Code'] == "404":
             return False
@@ -61,40 +166,320 @@ def s3_file_exists(url):
         return True
 
 
-def s3_save_to_bucket(data, url, content_type=None):
+_dedup_stats = {'uploaded': 0, 'skipped': 0, 'bytes_saved': 0}
+_dedup_stats_lock = threading.Lock()
+
+
+def _content_sha256(data, chunk_size=1024 * 1024):
+    """
+    Streaming sha256 of bytes, str or a seekable binary file object (which is put back where it was)
+    Returns:
+        (hex digest, size in bytes), (None, None) when the data can't be hashed without consuming it
+        or is a text mode file object, then it is uploaded without dedup
+    """
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    if isinstance(data, (bytes, bytearray)):
+        return hashlib.sha256(data).hexdigest(), len(data)
+    if not (hasattr(data, 'read') and hasattr(data, 'seekable') and data.seekable()):
+        return None, None
+    start = data.tell()
+    digest = hashlib.sha256()
+    size = 0
+    while True:
+        chunk = data.read(chunk_size)
+        if not isinstance(chunk, (bytes, bytearray)):
+            data.seek(start)
+            return None, None
+        if not chunk:
+            break
+        digest.update(chunk)
+        size += len(chunk)
+    data.seek(start)
+    return digest.hexdigest(), size
+
+
+def _stored_sha256(url):
+    """
+    sha256 in the metadata of the object on s3, always asked from s3 since other saves, copies and deletes
+    (from this or any other process) change the object without going through s3_save_to_bucket(dedup=True)
+    """
+    try:
+        return get_s3_client().head_object(Bucket=settings.BUCKET_NAME, Key=url)['Metadata'].get('sha256')
+    except ClientError as e:
+        if _is_not_found(e):
+            return None
+        raise
+
+
+def s3_dedup_stats():
+    """ .:e:.
+    Uploads done and skipped by s3_save_to_bucket(dedup=True) and the bytes that did not have to be sent
+    """
+    with _dedup_stats_lock:
+        return dict(_dedup_stats)
+
+
+def s3_save_to_bucket(data, url, content_type=None, dedup=False):
     """ .:e:.
     Args:
-        data:
-        url:
+        data: bytes, str or file object
+        url: File location inside s3
+        content_type:
+        dedup: skip the upload when the file on s3 already has the same content (sha256 stored in the metadata)
     """
     try:
         # Image Uploaded
         if url[0] == "/":
             url = url[1:]  # Cut away the preceding "/" so it saves to the correct location
-        s3_resource.Bucket(settings.BUCKET_NAME).put_object(Key=url, Body=data, ACL='private', ContentType=content_type)
+        kwargs = {'ACL': 'private'}
+        if content_type:
+            kwargs['ContentType'] = content_type
+        digest = None
+        if dedup:
+            digest, size = _content_sha256(data)
+        if digest is not None:
+            if _stored_sha256(url) == digest:
+                with _dedup_stats_lock:
+                    _dedup_stats['skipped'] += 1
+                    _dedup_stats['bytes_saved'] += size
+                return
+            kwargs['Metadata'] = {'sha256': digest}
+        get_s3_resource().Bucket(settings.BUCKET_NAME).put_object(Key=url, Body=data, **kwargs)
+        if digest is not None:
+            with _dedup_stats_lock:
+                _dedup_stats['uploaded'] += 1
     except Exception as e:
         print((str(e)))
 
 
+class S3StreamingWriter(object):
+    """ .:e:.
+    File-like object that uploads to the s3 bucket while it is being written to
+    Small files are saved with a single put_object. Once more than threshold bytes are written it switches to a
+    multipart upload and sends the parts from a thread pool, at most 2 parts per worker are held in memory.
+    If anything fails the multipart upload is aborted so no orphaned parts are left behind
+    Usage:
+        with S3StreamingWriter('media/temp/export.csv', content_type='text/csv') as writer:
+            writer.write(b'...')
+    """
+
+    def __init__(self, url, content_type=None, part_size=S3_MULTIPART_PART_SIZE, threshold=S3_MULTIPART_THRESHOLD,
+                 max_workers=S3_MULTIPART_WORKERS):
+        if url[0] == "/":
+            url = url[1:]  # Cut away the preceding "/" so it saves to the correct location
+        self.url = url
+        self.content_type = content_type
+        self.part_size = max(part_size, 5 * 1024 * 1024)
+        self.threshold = threshold
+        self.max_workers = max_workers
+        self.bytes_written = 0
+        self.closed = False
+        self._buffer = bytearray()
+        self._upload_id = None
+        self._executor = None
+        self._futures = []
+        self._slots = threading.BoundedSemaphore(max_workers * 2)
+
+    def write(self, data):
+        if self.closed:
+            raise ValueError('Write to a closed S3StreamingWriter')
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        self._buffer += data
+        self.bytes_written += len(data)
+        if self._upload_id is None and len(self._buffer) > self.threshold:
+            self._start_multipart()
+        if self._upload_id is not None:
+            while len(self._buffer) >= self.part_size:
+                self._upload_part(bytes(self._buffer[:self.part_size]))
+                del self._buffer[:self.part_size]
+        return len(data)
+
+    def writelines(self, chunks):
+        for chunk in chunks:
+            self.write(chunk)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if self._upload_id is None:
+                get_s3_client().put_object(Bucket=settings.BUCKET_NAME, Key=self.url, Body=bytes(self._buffer),
+                                     **self._object_args())
+            else:
+                if self._buffer or not self._futures:
+                    self._upload_part(bytes(self._buffer))
+                parts = [future.result() for future in self._futures]
+                get_s3_client().complete_multipart_upload(Bucket=settings.BUCKET_NAME, Key=self.url,
+                                                    UploadId=self._upload_id, MultipartUpload={'Parts': parts})
+            self._finish()
+        except Exception:
+            self.abort()
+            raise
+
+    def abort(self):
+        if self.closed:
+            return
+        for future in self._futures:
+            future.cancel()
+        self._finish()
+        if self._upload_id is not None:
+            get_s3_client().abort_multipart_upload(Bucket=settings.BUCKET_NAME, Key=self.url, UploadId=self._upload_id)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def _object_args(self):
+        args = {'ACL': 'private'}
+        if self.content_type:
+            args['ContentType'] = self.content_type
+        return args
+
+    def _start_multipart(self):
+        response = get_s3_client().create_multipart_upload(Bucket=settings.BUCKET_NAME, Key=self.url, **self._object_args())
+        self._upload_id = response['UploadId']
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers)
+
+    def _upload_part(self, data):
+        for future in self._futures:
+            if future.done() and future.exception() is not None:
+                raise future.exception()
+        self._slots.acquire()
+        future = self._executor.submit(self._send_part, len(self._futures) + 1, data)
+        future.add_done_callback(lambda f: self._slots.release())
+        self._futures.append(future)
+
+    def _send_part(self, part_number, data):
+        response = get_s3_client().upload_part(Bucket=settings.BUCKET_NAME, Key=self.url, UploadId=self._upload_id,
+                                         PartNumber=part_number, Body=data)
+        return {'PartNumber': part_number, 'ETag': response['ETag']}
+
+    def _finish(self):
+        self.closed = True
+        self._buffer = bytearray()
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+
+
+def s3_save_stream(data, url, content_type=None):
+    """ .:e:.
+    Saves bytes or an iterator of chunks to the s3 bucket without holding the whole file in memory
+    Args:
+        data: bytes/str or an iterator of bytes/str chunks
+        url: File location inside s3
+    Returns:
+        True if successful, False if unsuccessful
+    """
+    try:
+        with S3StreamingWriter(url, content_type=content_type) as writer:
+            if isinstance(data, (bytes, bytearray, str)):
+                writer.write(data)
+            else:
+                writer.writelines(data)
+        return True
+    except Exception as e:
+        print((str(e)))
+        return False
+
+
 def s3_list_all_objects(url):
     """ .:e:.
     Args:
         url:
     """
     try:
-        # Image Uploaded
-        if url[0] == "/":
-            url = url[1:]  # Cut away the preceding "/" so it saves to the correct location
-        items = []
-        bucket = s3_resource.Bucket(settings.BUCKET_NAME)
-        for item in bucket.objects.filter(Prefix=url):
-            if str(item.key[-1]) != "/":
-                items.append(item.key)
-        return items
+        return [item['key'] for item in s3_iter_objects(url) if item['key'][-1] != "/"]
     except Exception as e:
         print((str(e)))
 
 
+def s3_iter_objects(url, delimiter=None, start_after=None, page_size=1000):
+    """ .:e:.
+    Lists the files under a prefix one page at a time instead of building the whole list
+    Args:
+        url: prefix inside s3
+        delimiter: eg. "/" to only list one "directory" level, the sub directories are yielded as {'prefix'}
+        start_after: key to resume after, eg. the last key yielded by an earlier listing
+        page_size: keys per request, at most 1000
+    Yields:
+        {'key', 'size', 'last_modified'} per file
+    """
+    kwargs = {
+        'Bucket': settings.BUCKET_NAME,
+        'Prefix': _bucket_key(url) if url else '',
+        'PaginationConfig': {'PageSize': page_size}
+    }
+    if delimiter:
+        kwargs['Delimiter'] = delimiter
+    if start_after:
+        kwargs['StartAfter'] = start_after
+    for page in get_s3_client().get_paginator('list_objects_v2').paginate(**kwargs):
+        for common_prefix in page.get('CommonPrefixes', []):
+            yield {'prefix': common_prefix['Prefix']}
+        for item in page.get('Contents', []):
+            yield {'key': item['Key'], 'size': item['Size'], 'last_modified': item['LastModified']}
+
+
+def s3_iter_objects_parallel(urls, max_workers=S3_BATCH_WORKERS, **kwargs):
+    """ .:e:.
+    Lists several prefixes concurrently, the listings are interleaved in the order the pages arrive
+    Args:
+        urls: prefixes inside s3, eg. the {'prefix'} entries of a delimiter listing
+        kwargs: passed on to s3_iter_objects
+    Yields:
+        same as s3_iter_objects
+    """
+    urls = list(urls)
+    results = queue.Queue(maxsize=max_workers * 1000)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                results.put(item, timeout=1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def list_prefix(url):
+        try:
+            for item in s3_iter_objects(url, **kwargs):
+                if not put(item):
+                    return
+        except Exception as e:
+            put(e)
+        put(done)
+
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    try:
+        for url in urls:
+            executor.submit(list_prefix, url)
+        remaining = len(urls)
+        while remaining:
+            item = results.get()
+            if item is done:
+                remaining -= 1
+            elif isinstance(item, Exception):
+                raise item
+            else:
+                yield item
+    finally:
+        stop.set()
+        executor.shutdown(wait=False)
+
+
 def s3_get_from_bucket(url):
     """ .:e:.
     Gets and returns a file from s3 bucket
@@ -105,7 +490,7 @@ def s3_get_from_bucket(url):
         # Image Uploaded
         if url[0] == "/":
             url = url[1:]  # Cut away the preceding "/" so it saves to the correct location
-        obj = s3_resource.Object(settings.BUCKET_NAME, url)
+        obj = get_s3_resource().Object(settings.BUCKET_NAME, url)
         obj = obj.get()['Body'].read()
         return obj
     except ClientError as e:
@@ -118,6 +503,120 @@ def s3_get_from_bucket(url):
         raise
 
 
+def _is_not_found(e):
+    return e.response['Error']['Code'] in ["404", "NoSuchKey"]
+
+
+def s3_open(url, byte_range=None, if_match=None):
+    """ .:e:.
+    Opens a file in the s3 bucket for reading, nothing is downloaded until the body is read
+    Args:
+        url: File location inside s3
+        byte_range: (start, end) byte offsets, both inclusive, end None reads to the end of the file
+        if_match: ETag the file must still have, a ClientError (412) is raised if it changed
+    Returns:
+        file-like body with read(), iter_chunks() and close(), False if the file doesn't exist
+    """
+    if url[0] == "/":
+        url = url[1:]  # Cut away the preceding "/" so it saves to the correct location
+    kwargs = {}
+    if byte_range:
+        kwargs['Range'] = 'bytes=%s-%s' % (byte_range[0], '' if byte_range[1] is None else byte_range[1])
+    if if_match:
+        kwargs['IfMatch'] = if_match
+    try:
+        return get_s3_client().get_object(Bucket=settings.BUCKET_NAME, Key=url, **kwargs)['Body']
+    except ClientError as e:
+        if _is_not_found(e):
+            return False
+        else:
+            # Something has gone wrong.
+            raise
+
+
+def s3_get_range(url, start, end=None, if_match=None):
+    """ .:e:.
+    Gets part of a file from s3 bucket
+    Args:
+        url: File location inside s3
+        start: first byte
+        end: last byte (inclusive), None for the end of the file
+        if_match: ETag the file must still have, see s3_open
+    Returns:
+        bytes, False if the file doesn't exist
+    """
+    body = s3_open(url, (start, end), if_match)
+    if body is False:
+        return False
+    try:
+        return body.read()
+    finally:
+        body.close()
+
+
+def _iter_body(body, chunk_size):
+    try:
+        for chunk in body.iter_chunks(chunk_size):
+            yield chunk
+    finally:
+        body.close()
+
+
+def _get_part(url, start, end, etag):
+    # Every part must come from the version that was sized, a changed file fails with a 412 ClientError
+    part = s3_get_range(url, start, end, if_match=etag)
+    if part is False:
+        raise Exception('%s was deleted during the download' % url)
+    return part
+
+
+def _iter_parts(url, size, etag, part_size, max_workers):
+    # Keeps at most 2 parts per worker in flight and yields them in file order
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    try:
+        ranges = [(start, min(start + part_size, size) - 1) for start in range(0, size, part_size)]
+        pending = []
+        for byte_range in ranges:
+            pending.append(executor.submit(_get_part, url, byte_range[0], byte_range[1], etag))
+            if len(pending) >= max_workers * 2:
+                yield pending.pop(0).result()
+        for future in pending:
+            yield future.result()
+    finally:
+        executor.shutdown(wait=False)
+
+
+def s3_iter_file(url, chunk_size=S3_DOWNLOAD_CHUNK_SIZE, parallel=False, part_size=S3_DOWNLOAD_PART_SIZE,
+                 max_workers=S3_DOWNLOAD_WORKERS):
+    """ .:e:.
+    Streams a file from s3 bucket without loading it into memory,
+    eg. StreamingHttpResponse(s3_iter_file(url), content_type=...)
+    Args:
+        url: File location inside s3
+        chunk_size: size of the chunks yielded when streaming from a single request
+        parallel: download large files as concurrent ranged gets of part_size, chunks are still yielded in order.
+            The parts are pinned to the ETag of the file when the download starts, the iterator raises if the file
+            is changed or deleted during the download
+    Returns:
+        iterator of bytes chunks, False if the file doesn't exist
+    """
+    if parallel:
+        if url[0] == "/":
+            url = url[1:]  # Cut away the preceding "/" so it saves to the correct location
+        try:
+            head = get_s3_client().head_object(Bucket=settings.BUCKET_NAME, Key=url)
+        except ClientError as e:
+            if _is_not_found(e):
+                return False
+            raise
+        if head['ContentLength'] > part_size:
+            return _iter_parts(url, head['ContentLength'], head['ETag'], part_size, max_workers)
+    body = s3_open(url)
+    if body is False:
+        return False
+    return _iter_body(body, chunk_size)
+
+
 def s3_copy_file(old_url, new_url):
     """ .:e:.
     Copies a file to the new_url in s3 bucket
@@ -133,7 +632,7 @@ def s3_copy_file(old_url, new_url):
             old_url = old_url[1:]  # Cut away the preceding "/" so it saves to the correct location
         if new_url[0] == "/":
             new_url = new_url[1:]  # Cut away the preceding "/" so it saves to the correct location
-        s3_resource.Object(settings.BUCKET_NAME, new_url).copy_from(CopySource=settings.BUCKET_NAME + '/' + old_url)
+        get_s3_resource().Object(settings.BUCKET_NAME, new_url).copy_from(CopySource=settings.BUCKET_NAME + '/' + old_url)
         return True
     except Exception:
         return False
@@ -151,48 +650,174 @@ def s3_delete_file(url):
         # Image Uploaded
         if url[0] == "/":
             url = url[1:]  # Cut away the preceding "/" so it saves to the correct location
-        s3_resource.Object(settings.BUCKET_NAME, url).delete()
+        get_s3_resource().Object(settings.BUCKET_NAME, url).delete()
         return True
     except Exception:
         return False
 
 
-def s3_save_csv(headers, rows, url):
+def _bucket_key(url):
+    if url[0] == "/":
+        return url[1:]  # Cut away the preceding "/" so it saves to the correct location
+    return url
+
+
+def s3_delete_files(urls):
     """ .:e:.
+    Deletes many files in the aws s3 bucket, 1000 keys per request
     Args:
-        data:
-        url:
+        urls: File locations inside s3
+    Returns:
+        {url: True if deleted, False if unsuccessful}
+    """
+    results = {}
+    keys = [(url, _bucket_key(url)) for url in urls]
+    for start in range(0, len(keys), S3_DELETE_BATCH_SIZE):
+        batch = keys[start:start + S3_DELETE_BATCH_SIZE]
+        try:
+            response = get_s3_client().delete_objects(Bucket=settings.BUCKET_NAME, Delete={
+                'Objects': [{'Key': key} for url, key in batch],
+                'Quiet': True
+            })
+            failed = set(error['Key'] for error in response.get('Errors', []))
+            for url, key in batch:
+                results[url] = key not in failed
+        except Exception as e:
+            print((str(e)))
+            for url, key in batch:
+                results[url] = False
+    return results
+
+
+def s3_copy_files(urls, max_workers=S3_BATCH_WORKERS):
+    """ .:e:.
+    Copies many files in s3 bucket concurrently, large files are copied as a multipart copy
+    The parts of a multipart copy share the client's S3_MAX_POOL_CONNECTIONS with the other workers
+    Args:
+        urls: iterable of (old_url, new_url)
+    Returns:
+        {new_url: True if successful, False if unsuccessful}
+    """
+    from boto3.s3.transfer import TransferConfig
+    transfer_config = TransferConfig(max_concurrency=max(S3_MAX_POOL_CONNECTIONS // max(max_workers, 1), 1))
+
+    def copy(urls):
+        old_url, new_url = urls
+        try:
+            get_s3_client().copy({'Bucket': settings.BUCKET_NAME, 'Key': _bucket_key(old_url)},
+                           settings.BUCKET_NAME, _bucket_key(new_url), Config=transfer_config)
+            return new_url, True
+        except Exception:
+            return new_url, False
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return dict(executor.map(copy, list(urls)))
+
+
+def s3_files_exist(urls):
+    """ .:e:.
+    Checks which files exist on s3 bucket with one listing of the prefix the files share
+    Best used for files in the same folder, files that share no prefix will list the whole bucket
+    Args:
+        urls: File locations inside s3
+    Returns:
+        {url: True if the file exists, False if it doesn't}
+    """
+    keys = dict((url, _bucket_key(url)) for url in urls)
+    if not keys:
+        return {}
+    wanted = set(keys.values())
+    last_key = max(wanted)
+    existing = set()
+    for item in s3_iter_objects(os.path.commonprefix(list(wanted))):
+        if item['key'] in wanted:
+            existing.add(item['key'])
+        # Keys are listed in order, stop once past the last one asked for
+        if item['key'] >= last_key:
+            break
+    return dict((url, key in existing) for url, key in keys.items())
+
+
+def _csv_row_values(headers, row):
+    """
+    Resolves once how the values are read from the rows, dict rows are keyed by the lower case header
+    """
+    if not isinstance(row, dict):
+        return lambda row: row
+    keys = [key.lower() for key in headers]
+    if len(keys) == 1:
+        return lambda row: (row[keys[0]],)
+    return operator.itemgetter(*keys)
+
+
+def s3_save_csv(headers, rows, url, compress=False):
+    """ .:e:.
+    Writes the rows as csv straight into a (multipart) upload to the s3 bucket
+    Args:
+        headers: column names
+        rows: iterable of dicts keyed by the lower case header, or of sequences in header order
+        url: File location inside s3 media
+        compress: gzip the csv
+    Returns:
+        True if successful, False if unsuccessful
     """
     try:
         url = 'media/' + url
-        # Add headers to CSV
-        index = 0
-        csvContent = ''
-        for key in headers:
-            index = index + 1
-            csvContent += (key + ',') if (index < len(headers)) else (key + "\n")
-        
-        i = 0
-        for row in rows:
-            i = i + 1
-            dataString = ''
-            for key in headers:
-                if (row[key.lower()]):
-                    # Add leading quotation mark
-                    dataString += '"'
-                    dataString += str(row[key.lower()])
-                    # Add trailing quotation mark
-                    dataString += '"'
-                dataString += ','
-            dataString = dataString[:-1]
-
-            csvContent += dataString + "\n"
-        csvContent = csvContent[:-1]
-        # Image Uploaded
-        if url[0] == "/":
-            url = url[1:]  # Cut away the preceding "/" so it saves to the correct location
-        s3_resource.Bucket(settings.BUCKET_NAME).put_object(Key=url, Body=csvContent, ACL='private')
+        content_type = 'application/gzip' if compress else 'text/csv'
+        with S3StreamingWriter(url, content_type=content_type) as writer:
+            output = gzip.GzipFile(fileobj=writer, mode='wb') if compress else writer
+            buffer = io.StringIO()
+            csv_writer = csv.writer(buffer, lineterminator='\n')
+            csv_writer.writerow(headers)
+            row_values = None
+            for index, row in enumerate(rows, 1):
+                if row_values is None:
+                    row_values = _csv_row_values(headers, row)
+                csv_writer.writerow(row_values(row))
+                if index % CSV_BATCH_ROWS == 0:
+                    output.write(buffer.getvalue().encode('utf-8'))
+                    buffer.seek(0)
+                    buffer.truncate()
+            output.write(buffer.getvalue().encode('utf-8'))
+            if compress:
+                output.close()
         return True
     except Exception as e:
         print((str(e)))
         return False
+
+
+_async_executor = None
+_async_executor_lock = threading.Lock()
+
+
+def _run_async(func, *args, **kwargs):
+    global _async_executor
+    if _async_executor is None:
+        with _async_executor_lock:
+            if _async_executor is None:
+                _async_executor = ThreadPoolExecutor(max_workers=S3_ASYNC_WORKERS, thread_name_prefix='s3_async')
+    return asyncio.get_running_loop().run_in_executor(_async_executor, functools.partial(func, *args, **kwargs))
+
+
+# asyncio versions of the s3 functions, eg. await asyncio.gather(*[async_s3_get_from_bucket(url) for url in urls])
+# At most S3_ASYNC_WORKERS calls run at the same time, the rest wait their turn
+
+async def async_s3_save_to_bucket(data, url, content_type=None):
+    return await _run_async(s3_save_to_bucket, data, url, content_type)
+
+
+async def async_s3_get_from_bucket(url):
+    return await _run_async(s3_get_from_bucket, url)
+
+
+async def async_s3_list_all_objects(url):
+    return await _run_async(s3_list_all_objects, url)
+
+
+async def async_s3_copy_file(old_url, new_url):
+    return await _run_async(s3_copy_file, old_url, new_url)
+
+
+async def async_s3_delete_file(url):
+    return await _run_async(s3_delete_file, url)
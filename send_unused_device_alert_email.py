@@ -1,9 +1,12 @@
 import logging
+ from collections import OrderedDict, deque
+ from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
  from datetime import date, timedelta, datetime
  
  from dateutil import parser
  from django.conf import settings
  from django.core.management.base import BaseCommand
+ from django.db import connections
  from django.template import loader
  
  from bs4 import BeautifulSoup
@@ -16,6 +19,12 @@ import logging
  
  
  class Command(BaseCommand):
+     def add_arguments(self, parser):
+         parser.add_argument('--workers', type=int, default=4,
+                             help='Number of companies processed in parallel')
+         parser.add_argument('--instance-concurrency', type=int, default=2,
+                             help='Maximum number of companies processed in parallel per Mobiloan instance')
+ 
      def handle(self, *args, **options):
          """
          :param args:
@@ -31,131 +40,196 @@ import logging
              logger.error('Unable to check if workday')
  
          logger.info("*" * 30 + " Starting unused_device_alert_email" + "*" * 30)
+         workers = max(options['workers'], 1)
+         instance_concurrency = max(options['instance_concurrency'], 1)
+ 
+         # (mobiloan_instance, company) in the order their messages are logged
+         companies = []
+         # Companies not started yet per instance, they are started round robin over the instances
+         # and at most instance_concurrency at a time per instance
+         pending = OrderedDict()
          mobiloan_instances = MobiloanInstance.objects.all()
          for mobiloan_instance in mobiloan_instances:
-             companies = mobiloan_instance.company_set.all()
-             for company in companies:
+             for company in mobiloan_instance.company_set.all():
+                 pending.setdefault(mobiloan_instance.pk, deque()).append(len(companies))
+                 companies.append((mobiloan_instance, company))
+         running = dict((key, 0) for key in pending)
+         futures = [None] * len(companies)
+         next_to_log = 0
+ 
+         with ThreadPoolExecutor(max_workers=workers) as executor:
+             active = {}  # future: instance key
+             while pending or active:
+                 started = True
+                 while started and len(active) < workers:
+                     started = False
+                     for key in list(pending):
+                         if len(active) >= workers:
+                             break
+                         if running[key] >= instance_concurrency:
+                             continue
+                         index = pending[key].popleft()
+                         if not pending[key]:
+                             del pending[key]
+                         future = executor.submit(self.process_company, *companies[index])
+                         futures[index] = future
+                         active[future] = key
+                         running[key] += 1
+                         started = True
+ 
+                 done = wait(active, return_when=FIRST_COMPLETED)[0]
+                 for future in done:
+                     running[active.pop(future)] -= 1
+ 
+                 # Write the messages in company order so the log doesn't interleave
+                 while next_to_log < len(companies) and futures[next_to_log] is not None \
+                         and futures[next_to_log].done():
+                     self.log_messages(companies[next_to_log][1], futures[next_to_log])
+                     next_to_log += 1
+         logger.info("*" * 30 + " Finished unused_device_alert_email" + "*" * 30)
+ 
+     def log_messages(self, company, future):
+         try:
+             messages = future.result()
+         except Exception as e:
+             messages = [('error', 'Unused device error for ' + company.trading_name + ' :' + str(e))]
+         for level, message in messages:
+             if level == 'stdout':
+                 self.stdout.write(message)
+             else:
+                 getattr(logger, level)(message)
+ 
+     def process_company(self, mobiloan_instance, company):
+         """
+         Emails the unused device alerts for a company and its branches, runs on a worker thread
+         :param mobiloan_instance:
+         :param company:
+         :return: [(level, message)] to log once all companies before this one were logged
+         """
+         messages = []
+         try:
+             # UNUSED DEVICES FOR COMPANY
+             # Get Journey Company
+             journey_company = JourneyCompany(api_user=mobiloan_instance.api_username,
+                                              api_password=mobiloan_instance.api_password)
+             journey_company.fetch(object_id=company.journey_id)
+             if journey_company.device_not_connected_warning_days:
+                 period = journey_company.device_not_connected_warning_days
+             else:
+                 return messages
+             boundary_date = date.today() - timedelta(days=period)
+ 
+             # Query for devices
+             device_instance = JourneyWorker(api_user=mobiloan_instance.api_username,
+                                             api_password=mobiloan_instance.api_password)
+             devices = device_instance.query([('q', 'company_id', journey_company.id),
+                                              ('q', '_updated_at.lt', boundary_date),
+                                              ('q', 'status', 0),
+                                              ('sort', 'name', 'asc')])
+ 
+             # Parse dates on devices
+             for device in devices:
+                 if device.date_login is not None:
+                     device.date_login = parser.parse(device.date_login)
+                 if device.enrollment['last_connected'] is not None:
+                     device.enrollment['last_connected'] = parser.parse(device.enrollment['last_connected'])
+ 
+             if devices:
+                 messages.append(('info', 'Found %s unused devices for %s ' % (len(devices), company.trading_name)))
+                 # Populate and email the template the the branch email address
+                 data = {
+                     'now': datetime.now(),
+                     'environment': settings.ENVIRONMENT,
+                     'devices': devices,
+                     'company': company
+                 }
                  try:
-                     # UNUSED DEVICES FOR COMPANY
-                     # Get Journey Company
-                     journey_company = JourneyCompany(api_user=mobiloan_instance.api_username,
-                                                      api_password=mobiloan_instance.api_password)
-                     journey_company.fetch(object_id=company.journey_id)
-                     if journey_company.device_not_connected_warning_days:
-                         period = journey_company.device_not_connected_warning_days
-                     else:
-                         break
-                     boundary_date = date.today() - timedelta(days=period)
- 
-                     # Query for devices
-                     device_instance = JourneyWorker(api_user=mobiloan_instance.api_username,
-                                                     api_password=mobiloan_instance.api_password)
-                     devices = device_instance.query([('q', 'company_id', journey_company.id),
-                                                      ('q', '_updated_at.lt', boundary_date),
-                                                      ('q', 'status', 0),
-                                                      ('sort', 'name', 'asc')])
+                     email_template = loader.get_template('email_templates/unused_device_alert_email.html')
+                     email_html = email_template.render(data)
+                 except Exception as e:
+                     error_msg = 'Error loading email template: ' + str(e)
+                     messages.append(('error', error_msg))
+                     messages.append(('stdout', 'Error'))
+                     raise e
+ 
+                 # Email
+                 try:
+                     # Parse html content to prevent lines being too long (mail server limit is 990 char)
+                     soup = BeautifulSoup(email_html, features="html5lib")
+                     content = soup.prettify()
+                     subject = 'Mobiloan - %s - Unused Devices Alert' % journey_company.trading_name
+                     tasks.email(
+                         content=content,
+                         subject=subject,
+                         to_address=journey_company.email_address,
+                         from_address='no-reply@modalityapps.com'
+                     )
+                 except Exception as e:
+                     error_msg = "Error sending email. " + str(e)
+                     messages.append(('error', error_msg))
+                     messages.append(('stdout', 'Error'))
+                     raise e
+ 
+             # UNUSED DEVICES FOR BRANCHES
+             branches = MobiloanBranch.objects.filter(company=company)
+             for branch in branches:
+                 # Query for devices
+                 device_instance = JourneyWorker(api_user=mobiloan_instance.api_username,
+                                                 api_password=mobiloan_instance.api_password)
+                 devices = device_instance.query([('q', 'branch_id', branch.journey_id),
+                                                  ('q', '_updated_at.lt', boundary_date)])
+ 
+                 if devices:
  
                      # Parse dates on devices
                      for device in devices:
-                         if device.date_login is not None:
-                             device.date_login = parser.parse(device.date_login)
+                         device.updated_at = parser.parse(device._updated_at)
                          if device.enrollment['last_connected'] is not None:
                              device.enrollment['last_connected'] = parser.parse(device.enrollment['last_connected'])
  
-                     if devices:
-                         logger.info('Found %s unused devices for %s ' % (len(devices), company.trading_name))
-                         # Populate and email the template the the branch email address
-                         data = {
-                             'now': datetime.now(),
-                             'environment': settings.ENVIRONMENT,
-                             'devices': devices,
-                             'company': company
-                         }
-                         try:
-                             email_template = loader.get_template('email_templates/unused_device_alert_email.html')
-                             email_html = email_template.render(data)
-                         except Exception as e:
-                             error_msg = 'Error loading email template: ' + str(e)
-                             logger.error(error_msg)
-                             self.stdout.write('Error')
-                             raise e
- 
-                         # Email
-                         try:
-                             # Parse html content to prevent lines being too long (mail server limit is 990 char)
-                             soup = BeautifulSoup(email_html, features="html5lib")
-                             content = soup.prettify()
-                             subject = 'Mobiloan - %s - Unused Devices Alert' % journey_company.trading_name
-                             tasks.email(
-                                 content=content,
-                                 subject=subject,
-                                 to_address=journey_company.email_address,
-                                 from_address='no-reply@modalityapps.com'
-                             )
-                         except Exception as e:
-                             error_msg = "Error sending email. " + str(e)
-                             logger.error(error_msg)
-                             self.stdout.write('Error')
-                             raise e
- 
-                     # UNUSED DEVICES FOR BRANCHES
-                     branches = MobiloanBranch.objects.filter(company=company)
-                     for branch in branches:
-                         # Query for devices
-                         device_instance = JourneyWorker(api_user=mobiloan_instance.api_username,
-                                                         api_password=mobiloan_instance.api_password)
-                         devices = device_instance.query([('q', 'branch_id', branch.journey_id),
-                                                          ('q', '_updated_at.lt', boundary_date)])
- 
-                         if devices:
- 
-                             # Parse dates on devices
-                             for device in devices:
-                                 device.updated_at = parser.parse(device._updated_at)
-                                 if device.enrollment['last_connected'] is not None:
-                                     device.enrollment['last_connected'] = parser.parse(device.enrollment['last_connected'])
- 
-                             # Get Journey Branch
-                             journey_branch = JourneyBranch(api_user=mobiloan_instance.api_username,
-                                                            api_password=mobiloan_instance.api_password)
-                             journey_branch.fetch(object_id=branch.journey_id)
- 
-                             logger.info('Found %s unused devices for %s ' % (len(devices), company.trading_name))
-                             # Populate and email the template the the branch email address
-                             data = {
-                                 'now': datetime.now(),
-                                 'environment': settings.ENVIRONMENT,
-                                 'devices': devices,
-                                 'company': company,
-                                 'branch': branch
-                             }
-                             try:
-                                 email_template = loader.get_template('email_templates/unused_device_alert_email.html')
-                                 email_html = email_template.render(data)
-                             except Exception as e:
-                                 error_msg = 'Error loading email template: ' + str(e)
-                                 logger.error(error_msg)
-                                 self.stdout.write('Error')
-                                 raise e
- 
-                             # Email
-                             try:
-                                 # Parse html content to prevent lines being too long (mail server limit is 990 char)
-                                 soup = BeautifulSoup(email_html, features="html5lib")
-                                 content = soup.prettify()
-                                 subject = 'Mobiloan - %s - Unused Devices Alert' % branch.name
-                                 tasks.email(
-                                     content=content,
-                                     subject=subject,
-                                     to_address=journey_branch.email_address,
-                                     from_address='no-reply@modalityapps.com'
-                                 )
-                             except Exception as e:
-                                 error_msg = "Error sending email. " + str(e)
-                                 logger.error(error_msg)
-                                 self.stdout.write('Error')
-                                 raise e
-                 except Exception as e:
-                     logger.error('Unused device error for ' + company.trading_name + ' :' + str(e))
-                     continue
-         logger.info("*" * 30 + " Finished unused_device_alert_email" + "*" * 30)
\ No newline at end of file
+                     # Get Journey Branch
+                     journey_branch = JourneyBranch(api_user=mobiloan_instance.api_username,
+                                                    api_password=mobiloan_instance.api_password)
+                     journey_branch.fetch(object_id=branch.journey_id)
+ 
+                     messages.append(('info', 'Found %s unused devices for %s ' % (len(devices), company.trading_name)))
+                     # Populate and email the template the the branch email address
+                     data = {
+                         'now': datetime.now(),
+                         'environment': settings.ENVIRONMENT,
+                         'devices': devices,
+                         'company': company,
+                         'branch': branch
+                     }
+                     try:
+                         email_template = loader.get_template('email_templates/unused_device_alert_email.html')
+                         email_html = email_template.render(data)
+                     except Exception as e:
+                         error_msg = 'Error loading email template: ' + str(e)
+                         messages.append(('error', error_msg))
+                         messages.append(('stdout', 'Error'))
+                         raise e
+ 
+                     # Email
+                     try:
+                         # Parse html content to prevent lines being too long (mail server limit is 990 char)
+                         soup = BeautifulSoup(email_html, features="html5lib")
+                         content = soup.prettify()
+                         subject = 'Mobiloan - %s - Unused Devices Alert' % branch.name
+                         tasks.email(
+                             content=content,
+                             subject=subject,
+                             to_address=journey_branch.email_address,
+                             from_address='no-reply@modalityapps.com'
+                         )
+                     except Exception as e:
+                         error_msg = "Error sending email. " + str(e)
+                         messages.append(('error', error_msg))
+                         messages.append(('stdout', 'Error'))
+                         raise e
+         except Exception as e:
+             messages.append(('error', 'Unused device error for ' + company.trading_name + ' :' + str(e)))
+         finally:
+             # Worker threads get their own database connection
+             connections.close_all()
+         return messages
\ No newline at end of file
@@ -3,11 +3,14 @@
 """Utility methods for the project"""
 
 import datetime
+import json
 import requests
 import iso8601
 import os
+import threading
 import time
 import datetime
+from collections import OrderedDict
 from dateutil.parser import parse
 
 
@@ -138,6 +141,152 @@ class DictDiffer(object):
         return set(o for o in self.intersect if self.past_dict[o] == self.current_dict[o])
 
 
+class LRUCache(object):
+    """
+    Thread safe least recently used cache
+    Entries can expire after ttl seconds, either set per cache or per entry
+    With maxweight the total weigher(value) of all entries is kept under maxweight as well
+    """
+
+    def __init__(self, maxsize=128, ttl=None, maxweight=None, weigher=len):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.maxweight = maxweight
+        self.weigher = weigher
+        self.weight = 0
+        self._data = OrderedDict()  # key: (value, expires at, weight)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None and (item[1] is None or item[1] > time.time()):
+                self._data.move_to_end(key)
+                self.hits += 1
+                return item[0]
+            if item is not None:
+                self._remove(key)
+            self.misses += 1
+            return default
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        expires = time.time() + ttl if ttl is not None else None
+        weight = self.weigher(value) if self.maxweight is not None else 0
+        if self.maxweight is not None and weight > self.maxweight:
+            return
+        with self._lock:
+            self._remove(key)
+            self._data[key] = (value, expires, weight)
+            self.weight += weight
+            while len(self._data) > self.maxsize or (self.maxweight is not None and self.weight > self.maxweight):
+                self.weight -= self._data.popitem(last=False)[1][2]
+                self.evictions += 1
+
+    def pop(self, key, default=None):
+        with self._lock:
+            item = self._remove(key)
+        return default if item is None else item[0]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.weight = 0
+
+    def _remove(self, key):
+        item = self._data.pop(key, None)
+        if item is not None:
+            self.weight -= item[2]
+        return item
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions, 'size': len(self._data),
+                'weight': self.weight}
+
+
+class Datamodel(object):
+    """
+    A parsed datamodel json file with its lookup tables built once
+    field_types: {model: {field: type}}
+    options: {model: {field: options}}
+    option_displays: {model: {field: {code: display}}}
+    """
+
+    def __init__(self, data, version, models_key=None):
+        self.data = data
+        self.version = version
+        self.field_types = {}
+        self.options = {}
+        self.option_displays = {}
+        models = data[models_key] if models_key else data
+        for model_name, model in models.items():
+            if not isinstance(model, dict):
+                continue
+            field_types = self.field_types[model_name] = {}
+            options = self.options[model_name] = {}
+            option_displays = self.option_displays[model_name] = {}
+            for field_name, field in (model.get('fields') or {}).items():
+                if 'type' in field:
+                    field_types[field_name] = field['type']
+                if field.get('options'):
+                    options[field_name] = field['options']
+                    items = enumerate(field['options']) if isinstance(field['options'], list) else field['options'].items()
+                    option_displays[field_name] = dict((code, option['display']) for code, option in items
+                                                       if isinstance(option, dict) and 'display' in option)
+
+
+class DatamodelRegistry(object):
+    """
+    Loads datamodel json files once per process and reloads them when the file changes on disk
+    Keeps hit, miss and reload counts
+    """
+
+    def __init__(self):
+        self._datamodels = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.reloads = 0
+
+    def get(self, path, models_key=None):
+        """
+        Args:
+            path: location of the datamodel json file
+            models_key: key the models are nested under, None if they are at the top level
+        Returns:
+            Datamodel
+        """
+        stat = os.stat(path)
+        version = (stat.st_mtime_ns, stat.st_size)
+        key = (path, models_key)
+        with self._lock:
+            datamodel = self._datamodels.get(key)
+            if datamodel is not None and datamodel.version == version:
+                self.hits += 1
+                return datamodel
+            if datamodel is None:
+                self.misses += 1
+            else:
+                self.reloads += 1
+        with open(path, 'r') as f:
+            datamodel = Datamodel(json.loads(f.read()), version, models_key)
+        with self._lock:
+            self._datamodels[key] = datamodel
+        return datamodel
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'reloads': self.reloads}
+
+
+datamodel_registry = DatamodelRegistry()
+
+
 def split_into_list(var, separator=","):
     """                                                ___
     Converts and splits variables to a list      _____/_O_\_____